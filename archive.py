@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Create and extract toolchain packages with multithreaded compressors.
+
+Packages are reproducible: entries are sorted, owners are dropped, modes are
+normalized to 0755 or 0644 and mtimes are set to SOURCE_DATE_EPOCH (0 if it
+is unset). The tar stream is written straight into the compressor, so no
+uncompressed tarball is written. A sha256sum manifest of the packaged files
+is written next to each package.
+
+Run with 'benchmark DIR' to compare the size and time of every format on an
+install tree.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+FORMATS = ('bz2', 'xz', 'zstd')
+# bzip2 has no multithreaded compressor that writes the same bytes as bzip2,
+# so the default format is a multithreaded one.
+DEFAULT_FORMAT = 'xz'
+EXTENSIONS = {'bz2': '.tar.bz2', 'xz': '.tar.xz', 'zstd': '.tar.zst'}
+DEFAULT_LEVELS = {'bz2': 9, 'xz': 6, 'zstd': 19}
+BENCHMARK_LEVELS = {'bz2': (9,), 'xz': (6, 9), 'zstd': (3, 10, 19)}
+MANIFEST_EXTENSION = '.sha256'
+# Dictionary size of each xz preset level. xz blocks are always three times
+# the dictionary size, xz's own default, so that the output does not depend on
+# the number of threads.
+XZ_DICT_SIZES = {
+    0: 256 << 10,
+    1: 1 << 20,
+    2: 2 << 20,
+    3: 4 << 20,
+    4: 4 << 20,
+    5: 8 << 20,
+    6: 8 << 20,
+    7: 16 << 20,
+    8: 32 << 20,
+    9: 64 << 20,
+}
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+def find_program(name):
+    """Returns the path of name in PATH, or None."""
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        program = os.path.join(path, name)
+        if os.path.isfile(program) and os.access(program, os.X_OK):
+            return program
+    return None
+
+
+def compress_cmd(fmt, level, threads):
+    """Returns the command compressing stdin to stdout.
+
+    The output only depends on the input, the format and the level, never on
+    threads or on the tools installed.
+    """
+    if fmt == 'bz2':
+        # pbzip2 would use threads, but its output differs from bzip2's, and
+        # it is not installed everywhere.
+        return ['bzip2', '-%d' % level, '-c']
+    if fmt == 'xz':
+        # xz -T1 uses the single-threaded encoder, whose output differs from
+        # the multithreaded one's. Always use the latter.
+        return ['xz', '-%d' % level, '-T%d' % max(2, threads),
+                '--block-size=%d' % (3 * XZ_DICT_SIZES[level]), '-c']
+    if fmt == 'zstd':
+        cmd = ['zstd', '-%d' % level, '-T%d' % threads, '-q', '-c']
+        if level > 19:
+            cmd.append('--ultra')
+        return cmd
+    raise ValueError('Unknown package format: ' + fmt)
+
+
+def format_of(package):
+    """Returns the format of a package from its file name."""
+    for fmt, ext in EXTENSIONS.items():
+        if package.endswith(ext):
+            return fmt
+    raise ValueError('Unknown package format: ' + package)
+
+
+def decompress_cmd(fmt):
+    return {
+        'bz2': ['pbzip2' if find_program('pbzip2') else 'bzip2', '-dc'],
+        'xz': ['xz', '-dc'],
+        'zstd': ['zstd', '-dcq'],
+    }[fmt]
+
+
+def run_pipeline(producer, consumer, stdin=None, stdout=None):
+    """Runs producer | consumer and raises if either fails."""
+    logger().info('pipeline: %s | %s', subprocess.list2cmdline(producer),
+                  subprocess.list2cmdline(consumer))
+    first = subprocess.Popen(producer, stdin=stdin, stdout=subprocess.PIPE)
+    second = subprocess.Popen(consumer, stdin=first.stdout, stdout=stdout)
+    # Let the producer see SIGPIPE if the consumer exits early.
+    first.stdout.close()
+    second.wait()
+    first.wait()
+    for p, cmd in ((first, producer), (second, consumer)):
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
+def source_date_epoch():
+    """Returns the mtime of packaged files, from SOURCE_DATE_EPOCH."""
+    return int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+
+
+class HashingReader(object):
+    """File object wrapper hashing the data read through it."""
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def walk_sorted(top):
+    """Yields the paths under top, sorted, with directories before contents.
+
+    Symlinks to directories are yielded but not followed.
+    """
+    for entry in sorted(os.listdir(top)):
+        path = os.path.join(top, entry)
+        yield path
+        if os.path.isdir(path) and not os.path.islink(path):
+            for sub_path in walk_sorted(path):
+                yield sub_path
+
+
+def tar_info(path, arcname, mtime):
+    """Returns the normalized TarInfo of path."""
+    info = tarfile.TarInfo(arcname)
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    st = os.lstat(path)
+    if os.path.islink(path):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(path)
+        info.mode = 0o777
+    elif os.path.isdir(path):
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    else:
+        info.size = st.st_size
+        info.mode = 0o755 if st.st_mode & 0o111 else 0o644
+    return info
+
+
+def write_tar(tar_file, parent_dir, name):
+    """Writes parent_dir/name to the stream tar_file.
+
+    Hard links are stored as separate files, so the stream only depends on
+    the contents of the tree.
+
+    Returns:
+        List of (sha256, arcname) of the regular files written.
+    """
+    mtime = source_date_epoch()
+    top = os.path.join(parent_dir, name)
+    hashes = []
+    tar_file.addfile(tar_info(top, name, mtime))
+    for path in walk_sorted(top):
+        arcname = os.path.join(name, os.path.relpath(path, top))
+        info = tar_info(path, arcname, mtime)
+        if not info.isfile():
+            tar_file.addfile(info)
+            continue
+        with open(path, 'rb') as src:
+            reader = HashingReader(src)
+            tar_file.addfile(info, reader)
+        hashes.append((reader.sha256.hexdigest(), arcname))
+    return hashes
+
+
+def write_manifest(path, hashes):
+    """Writes hashes in the format of sha256sum."""
+    with open(path, 'w') as manifest:
+        for digest, arcname in sorted(hashes, key=lambda entry: entry[1]):
+            manifest.write('%s  %s\n' % (digest, arcname))
+
+
+def create(parent_dir, name, output_base, fmt, level=None, threads=1):
+    """Packages parent_dir/name into output_base plus the format's extension.
+
+    The sha256sum manifest of the package is written to the package path
+    plus MANIFEST_EXTENSION. The package does not depend on when or by whom
+    the tree was built, nor on threads.
+
+    Returns:
+        The path of the package.
+    """
+    if level is None:
+        level = DEFAULT_LEVELS[fmt]
+    package_path = output_base + EXTENSIONS[fmt]
+    cmd = compress_cmd(fmt, level, threads)
+    logger().info('tar %s | %s', os.path.join(parent_dir, name),
+                  subprocess.list2cmdline(cmd))
+    with open(package_path, 'wb') as package:
+        compressor = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=package)
+        try:
+            tar_file = tarfile.open(
+                fileobj=compressor.stdin, mode='w|',
+                format=tarfile.GNU_FORMAT)
+            hashes = write_tar(tar_file, parent_dir, name)
+            tar_file.close()
+        finally:
+            compressor.stdin.close()
+            compressor.wait()
+    if compressor.returncode != 0:
+        raise subprocess.CalledProcessError(compressor.returncode, cmd)
+    write_manifest(package_path + MANIFEST_EXTENSION, hashes)
+    return package_path
+
+
+def extract(package_path, dest_dir):
+    """Extracts a package created by create() into dest_dir."""
+    with open(package_path, 'rb') as package:
+        run_pipeline(decompress_cmd(format_of(package_path)),
+                     ['tar', '-xf', '-', '-C', dest_dir],
+                     stdin=package)
+
+
+def benchmark(tree, threads):
+    """Packages tree in every format and level of BENCHMARK_LEVELS.
+
+    Returns:
+        List of (format, level, seconds, size) tuples.
+    """
+    tree = os.path.abspath(tree)
+    parent_dir, name = os.path.split(tree)
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for fmt in FORMATS:
+            for level in BENCHMARK_LEVELS[fmt]:
+                start = time.time()
+                package = create(parent_dir, name,
+                                 os.path.join(tmp_dir, 'package'), fmt,
+                                 level, threads)
+                results.append((fmt, level, time.time() - start,
+                                os.path.getsize(package)))
+                os.remove(package)
+                os.remove(package + MANIFEST_EXTENSION)
+    finally:
+        os.rmdir(tmp_dir)
+    return results
+
+
+def print_benchmark(results):
+    largest = max(size for _, _, _, size in results)
+    print('%-6s %5s %9s %14s %7s' % ('format', 'level', 'seconds', 'bytes',
+                                     'size'))
+    for fmt, level, seconds, size in results:
+        print('%-6s %5d %9.1f %14d %6.1f%%' % (fmt, level, seconds, size,
+                                              100.0 * size / largest))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    benchmark_parser = subparsers.add_parser(
+        'benchmark', help='Compare the size and time of every format.')
+    benchmark_parser.add_argument('tree', help='Directory to package.')
+    benchmark_parser.add_argument(
+        '-j',
+        '--threads',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help='Compression threads (defaults to the number of CPUs).')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.command == 'benchmark':
+        print_benchmark(benchmark(args.tree, args.threads))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
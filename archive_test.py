@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for archive.py."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import archive
+
+
+class ReproducibleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        tree = os.path.join(self.tmp_dir, 'tree', 'clang-dev')
+        os.makedirs(os.path.join(tree, 'bin'))
+        with open(os.path.join(tree, 'bin', 'clang'), 'wb') as f:
+            f.write(os.urandom(1 << 20))
+        os.chmod(os.path.join(tree, 'bin', 'clang'), 0o700)
+        with open(os.path.join(tree, 'NOTICE'), 'w') as f:
+            f.write('notice\n' * 1000)
+        os.symlink('clang', os.path.join(tree, 'bin', 'clang++'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def create(self, fmt, threads):
+        output_base = os.path.join(self.tmp_dir, '%s-%d' % (fmt, threads))
+        package = archive.create(
+            os.path.join(self.tmp_dir, 'tree'), 'clang-dev', output_base,
+            fmt, threads=threads)
+        with open(package, 'rb') as f:
+            return f.read()
+
+    def test_threads_do_not_change_package(self):
+        for fmt in archive.FORMATS:
+            self.assertEqual(
+                self.create(fmt, 1), self.create(fmt, 4),
+                '%s packages differ between 1 and 4 threads' % fmt)
+
+    def test_extract(self):
+        dest_dir = os.path.join(self.tmp_dir, 'dest')
+        for fmt in archive.FORMATS:
+            self.create(fmt, 2)
+            os.mkdir(dest_dir)
+            package = os.path.join(self.tmp_dir,
+                                   '%s-2%s' % (fmt, archive.EXTENSIONS[fmt]))
+            archive.extract(package, dest_dir)
+            clang = os.path.join(dest_dir, 'clang-dev', 'bin', 'clang')
+            self.assertEqual(os.stat(clang).st_mode & 0o777, 0o755)
+            self.assertEqual(
+                os.readlink(os.path.join(dest_dir, 'clang-dev', 'bin',
+                                         'clang++')), 'clang')
+            shutil.rmtree(dest_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,20 +17,77 @@ https://docs.google.com/document/d/1yDgaUIa2O5w6dc3sSTe1ry-1ehKajTGJGQCbyn0fcEM
 
 from __future__ import print_function
 
+# Every compile of a bisect build imports this module. Modules only needed to
+# write new files, by the triage daemon or by the command line are imported
+# where they are used.
 import contextlib
+import errno
 import fcntl
+import hashlib
+import mmap
 import os
 import shutil
+import struct
 import subprocess
 import sys
+import time
 
 VALID_MODES = ['POPULATE_GOOD', 'POPULATE_BAD', 'TRIAGE']
 GOOD_CACHE = 'good'
 BAD_CACHE = 'bad'
 LIST_FILE = os.path.join(GOOD_CACHE, '_LIST')
+BAD_SET_INDEX = '_BAD_SET_INDEX'
+# Cached outputs are stored once per unique content under BLOB_DIR. Each
+# population keeps a MANIFEST_FILE mapping cached paths to blob digests.
+BLOB_DIR = '_BLOBS'
+MANIFEST_FILE = '_MANIFEST'
+# Records the copy strategy probed for a bisect dir and its throughput.
+COPY_STRATEGY_FILE = '_COPY_STRATEGY'
+# Populate processes append their log and manifest records to per-host files
+# in SHARD_DIR; finalize_population merges them into the populate log and the
+# manifest. Objects are appended to _LIST directly.
+SHARD_DIR = '_SHARDS'
+POPULATE_LOG = '_POPULATE_LOG'
+SHARD_BLOCK_END = 'E\n'
+COPY_PROBE_SIZE = 4 << 20
+# Linux ioctl sharing the extents of one file with another (a reflink).
+FICLONE = 0x40049409
+# Suffixes of the files kept next to each population's _LIST. The digest log
+# gets one fixed size record appended per listed object, the index is the
+# sorted form of it used for lookups.
+DIGEST_LOG_SUFFIX = '.digests'
+INDEX_SUFFIX = '.index'
+INDEX_LOCK_SUFFIX = '.lock'
+
+# On-disk indexes are a header followed by sorted, fixed size path digests.
+# The header holds the mtime, size and path digest of the indexed file.
+INDEX_MAGIC = b'BISECTIDX2'
+INDEX_HEADER = struct.Struct('<10sdQ16s')
+INDEX_DIGEST_SIZE = 16
+
+# Unix socket of the optional triage daemon, relative to the bisect dir.
+DAEMON_SOCKET = '_DAEMON_SOCKET'
+DAEMON_TIMEOUT = 10
+# Daemon answer for objects that are not in the good population's list.
+MISSING = 'missing'
 
 CONTINUE_ON_MISSING = os.environ.get('BISECT_CONTINUE_ON_MISSING', None) == '1'
 WRAPPER_SAFE_MODE = os.environ.get('BISECT_WRAPPER_SAFE_MODE', None) == '1'
+ASYNC_POPULATE = os.environ.get('BISECT_ASYNC_POPULATE', None) == '1'
+
+# Markers for background cache writers that are still running, or failed.
+PENDING_DIR = '_PENDING'
+FAILED_DIR = '_FAILED'
+# Snapshots of the outputs of each background writer, named like its marker.
+STAGING_DIR = '_STAGING'
+FLUSH_TIMEOUT = 600
+# A writer records its pid right after forking, a marker without one for
+# longer than this is left behind by a dead writer.
+PID_GRACE = 60
+# Present in a population once it has been flushed, until it is populated
+# again. FLUSH_LOCK serializes the flushes of triage compiles.
+FLUSHED_FILE = '_FLUSHED'
+FLUSH_LOCK = '_FLUSH.lock'
 
 
 class Error(Exception):
@@ -95,16 +152,148 @@ def exec_and_return(execargs):
   return subprocess.call(execargs)
 
 
-def which_cache(obj_file):
+def _hostname():
+  """Return socket.gethostname(), without importing socket."""
+  return os.uname()[1]
+
+
+def _to_bytes(text):
+  if not isinstance(text, bytes):
+    text = text.encode('utf-8')
+  return text
+
+
+def path_digest(path):
+  """Return the fixed size digest used to key a path in on-disk indexes."""
+  return hashlib.md5(_to_bytes(path)).digest()
+
+
+def list_file_digests(list_path):
+  """Return the path digests of every line in a list file."""
+  with open(list_path, 'rb') as list_file:
+    return [path_digest(line.rstrip(b'\n')) for line in list_file]
+
+
+def _index_key(source_path):
+  st = os.stat(source_path)
+  return st.st_mtime, st.st_size, path_digest(os.path.abspath(source_path))
+
+
+def _search_sorted(records, count, digest):
+  """Binary search digest in records, an indexable of sorted digests."""
+  lo, hi = 0, count
+  while lo < hi:
+    mid = (lo + hi) // 2
+    record = records(mid)
+    if record < digest:
+      lo = mid + 1
+    elif record > digest:
+      hi = mid
+    else:
+      return True
+  return False
+
+
+def _search_index(index_path, key, digest):
+  """Look up digest in an index file.
+
+  Returns:
+    True or False if the index exists and was built for key, None if the
+    index is missing or stale.
+  """
+  try:
+    index = open(index_path, 'rb')
+  except IOError:
+    return None
+
+  with index:
+    header = index.read(INDEX_HEADER.size)
+    if len(header) != INDEX_HEADER.size:
+      return None
+    magic, mtime, size, source = INDEX_HEADER.unpack(header)
+    if magic != INDEX_MAGIC or (mtime, size, source) != key:
+      return None
+
+    index_size = os.fstat(index.fileno()).st_size
+    count = (index_size - INDEX_HEADER.size) // INDEX_DIGEST_SIZE
+    if not count:
+      return False
+
+    mapped = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+
+      def records(i):
+        start = INDEX_HEADER.size + i * INDEX_DIGEST_SIZE
+        return mapped[start:start + INDEX_DIGEST_SIZE]
+
+      return _search_sorted(records, count, digest)
+    finally:
+      mapped.close()
+
+
+def build_index(index_path, key, digests):
+  """Atomically write a sorted index of digests stamped with key.
+
+  Concurrent builders each write a private temporary file and rename it into
+  place, so readers never observe a partially written index.
+
+  Returns:
+    The sorted list of digests written to the index.
+  """
+  import tempfile
+  records = sorted(set(digests))
+  fd, tmp_path = tempfile.mkstemp(
+      dir=os.path.dirname(index_path), prefix='.tmp_index')
+  try:
+    with os.fdopen(fd, 'wb') as index:
+      index.write(INDEX_HEADER.pack(INDEX_MAGIC, *key))
+      index.write(b''.join(records))
+    os.rename(tmp_path, index_path)
+  except:
+    os.remove(tmp_path)
+    raise
+  return records
+
+
+def lookup_index(index_path, source_path, load_digests, digest):
+  """Check whether digest is a member of the set described by source_path.
+
+  The sorted index at index_path is built once from load_digests() and reused
+  for as long as the path, mtime and size of source_path match the ones
+  recorded in its header. Lookups are a binary search over the memory-mapped
+  index.
+
+  A stale index is rebuilt under a lock next to it, so concurrent compiles
+  wait for one builder and then read its index instead of all rebuilding it.
+  """
+  key = _index_key(source_path)
+  found = _search_index(index_path, key, digest)
+  if found is None:
+    with lock_file(index_path + INDEX_LOCK_SUFFIX, 'a'):
+      found = _search_index(index_path, key, digest)
+      if found is None:
+        records = build_index(index_path, key, load_digests())
+        found = _search_sorted(records.__getitem__, len(records), digest)
+  return found
+
+
+def which_cache(obj_file, bisect_dir):
   """Determine which cache an object belongs to.
 
   The binary search tool creates two files for each search iteration listing
   the full set of bad objects and full set of good objects. We use this to
   determine where an object file should be linked from (good or bad).
+
+  The bad set is indexed once per search iteration so each lookup is a binary
+  search instead of a scan of the whole list. There is a single index, which
+  is rebuilt whenever the bad set's path, mtime or size change, so the
+  indexes of earlier iterations do not pile up.
   """
   bad_set_file = os.environ.get('BISECT_BAD_SET')
-  ret = subprocess.call(['grep', '-x', '-q', obj_file, bad_set_file])
-  if ret == 0:
+  index_path = os.path.join(bisect_dir, BAD_SET_INDEX)
+  if lookup_index(index_path, bad_set_file,
+                  lambda: list_file_digests(bad_set_file),
+                  path_digest(obj_file)):
     return BAD_CACHE
   else:
     return GOOD_CACHE
@@ -119,9 +308,18 @@ def makedirs(path):
       raise
 
 
-def get_obj_path(execargs):
+def _abspath(path, cwd=None):
+  """Make path absolute relative to cwd, or to the current directory."""
+  if cwd is None:
+    return os.path.abspath(path)
+  return os.path.normpath(os.path.join(cwd, path))
+
+
+def get_obj_path(execargs, cwd=None):
   """Get the object path for the object file in the list of arguments.
 
+  Relative paths are relative to cwd if given, for commands read from a log.
+
   Returns:
     Absolute object path from execution args (-o argument). If no object being
     outputted or output doesn't end in ".o" then return empty string.
@@ -138,10 +336,10 @@ def get_obj_path(execargs):
     # TODO: need to handle -r compilations
     return ''
 
-  return os.path.abspath(obj_path)
+  return _abspath(obj_path, cwd)
 
 
-def get_dep_path(execargs):
+def get_dep_path(execargs, cwd=None):
   """Get the dep file path for the dep file in the list of arguments.
 
   Returns:
@@ -156,16 +354,16 @@ def get_dep_path(execargs):
   if '-MF' in execargs:
     i = execargs.index('-MF')
     dep_path = execargs[i + 1]
-    return os.path.abspath(dep_path)
+    return _abspath(dep_path, cwd)
 
-  full_obj_path = get_obj_path(execargs)
+  full_obj_path = get_obj_path(execargs, cwd)
   if not full_obj_path:
     return ''
 
   return full_obj_path[:-2] + '.d'
 
 
-def get_dwo_path(execargs):
+def get_dwo_path(execargs, cwd=None):
   """Get the dwo file path for the dwo file in the list of arguments.
 
   Returns:
@@ -175,27 +373,50 @@ def get_dwo_path(execargs):
   if '-gsplit-dwarf' not in execargs:
     return ''
 
-  full_obj_path = get_obj_path(execargs)
+  full_obj_path = get_obj_path(execargs, cwd)
   if not full_obj_path:
     return ''
 
   return full_obj_path[:-2] + '.dwo'
 
 
+def read_digest_log(log_path):
+  """Return the path digests recorded in a population's digest log."""
+  with open(log_path, 'rb') as digest_log:
+    data = digest_log.read()
+  # Ignore a trailing partial record, there should never be one.
+  end = len(data) - len(data) % INDEX_DIGEST_SIZE
+  return [data[i:i + INDEX_DIGEST_SIZE]
+          for i in range(0, end, INDEX_DIGEST_SIZE)]
+
+
 def in_object_list(obj_name, list_filename):
-  """Check if object file name exist in file with object list."""
+  """Check if object file name exist in file with object list.
+
+  Membership is answered from a sorted index built once from the digest log
+  that populate compiles append to next to the list. Caches populated without
+  a digest log are indexed from the list file itself.
+  """
   if not obj_name:
     return False
 
-  with lock_file(list_filename, 'r') as list_file:
-    for line in list_file:
-      if line.strip() == obj_name:
-        return True
+  digest_log = list_filename + DIGEST_LOG_SUFFIX
+  if os.path.exists(digest_log):
+    source_path = digest_log
+    read_digests = read_digest_log
+  else:
+    source_path = list_filename
+    read_digests = list_file_digests
+
+  def load_digests():
+    with lock_file(list_filename, 'r'):
+      return read_digests(source_path)
 
-    return False
+  return lookup_index(list_filename + INDEX_SUFFIX, source_path, load_digests,
+                      path_digest(obj_name))
 
 
-def get_side_effects(execargs):
+def get_side_effects(execargs, cwd=None):
   """Determine side effects generated by compiler
 
   Returns:
@@ -204,49 +425,518 @@ def get_side_effects(execargs):
   side_effects = []
 
   # Cache dependency files
-  full_dep_path = get_dep_path(execargs)
+  full_dep_path = get_dep_path(execargs, cwd)
   if full_dep_path:
     side_effects.append(full_dep_path)
 
   # Cache dwo files
-  full_dwo_path = get_dwo_path(execargs)
+  full_dwo_path = get_dwo_path(execargs, cwd)
   if full_dwo_path:
     side_effects.append(full_dwo_path)
 
   return side_effects
 
 
-def cache_file(execargs, bisect_dir, cache, abs_file_path):
-  """Cache compiler output file (.o/.d/.dwo)."""
+def _copy_reflink(src, dst):
+  with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _copy_file_range(src, dst):
+  if not hasattr(os, 'copy_file_range'):
+    raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+  with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+    remaining = os.fstat(fsrc.fileno()).st_size
+    while remaining > 0:
+      copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+      if not copied:
+        raise OSError(errno.EIO, 'copy_file_range made no progress')
+      remaining -= copied
+
+
+def _copy_sendfile(src, dst):
+  if not hasattr(os, 'sendfile'):
+    raise OSError(errno.ENOSYS, 'sendfile is not available')
+  with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+    size = os.fstat(fsrc.fileno()).st_size
+    offset = 0
+    while offset < size:
+      sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+      if not sent:
+        raise OSError(errno.EIO, 'sendfile made no progress')
+      offset += sent
+
+
+# Copy mechanisms from fastest to slowest. The last one always works.
+COPY_STRATEGIES = [
+    ('reflink', _copy_reflink),
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _copy_sendfile),
+    ('copy', shutil.copyfile),
+]
+
+# Copy strategy per bisect dir, so each process reads it at most once.
+_copy_strategy_cache = {}
+
+
+def probe_copy_strategy(bisect_dir):
+  """Find the fastest copy mechanism the bisect dir's filesystem supports.
+
+  Returns:
+    Tuple of (strategy name, measured throughput in bytes per second).
+  """
+  import tempfile
+  makedirs(bisect_dir)
+  fd, src = tempfile.mkstemp(dir=bisect_dir, prefix='.tmp_probe')
+  with os.fdopen(fd, 'wb') as probe:
+    probe.write(os.urandom(COPY_PROBE_SIZE))
+  dst = src + '.copy'
+  try:
+    for name, copy in COPY_STRATEGIES:
+      start = time.time()
+      try:
+        copy(src, dst)
+      except (IOError, OSError):
+        continue
+      elapsed = max(time.time() - start, 1e-6)
+      return name, COPY_PROBE_SIZE / elapsed
+  finally:
+    for path in (src, dst):
+      if os.path.exists(path):
+        os.remove(path)
+
+
+def read_copy_strategy(bisect_dir):
+  """Read the recorded copy strategy as (name, throughput) or None."""
+  try:
+    with open(os.path.join(bisect_dir, COPY_STRATEGY_FILE)) as f:
+      name, throughput = f.read().split()
+  except (IOError, ValueError):
+    return None
+  return name, float(throughput)
+
+
+def get_copy_strategy(bisect_dir):
+  """Get the copy strategy for a bisect dir, probing it the first time."""
+  if bisect_dir in _copy_strategy_cache:
+    return _copy_strategy_cache[bisect_dir]
+
+  recorded = read_copy_strategy(bisect_dir)
+  if recorded is None:
+    import tempfile
+    recorded = probe_copy_strategy(bisect_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=bisect_dir, prefix='.tmp_strategy')
+    with os.fdopen(fd, 'w') as f:
+      f.write('%s %f\n' % recorded)
+    os.rename(tmp_path, os.path.join(bisect_dir, COPY_STRATEGY_FILE))
+    print('bisect: using %s copy strategy (%.1f MB/s)' %
+          (recorded[0], recorded[1] / (1 << 20)), file=sys.stderr)
+
+  name = recorded[0]
+  if name not in [strategy for strategy, _ in COPY_STRATEGIES]:
+    name = 'copy'
+  _copy_strategy_cache[bisect_dir] = name
+  return name
+
+
+def copy_file(bisect_dir, src, dst, copy_stat=True):
+  """Copy src to dst using the bisect dir's copy strategy.
+
+  If the chosen mechanism does not work for this particular pair of files
+  (e.g. a reflink across filesystems) the slower strategies are tried in
+  order.
+  """
+  names = [name for name, _ in COPY_STRATEGIES]
+  start = names.index(get_copy_strategy(bisect_dir))
+  for name, copy in COPY_STRATEGIES[start:]:
+    try:
+      copy(src, dst)
+      break
+    except (IOError, OSError):
+      if name == COPY_STRATEGIES[-1][0]:
+        raise
+  if copy_stat:
+    shutil.copystat(src, dst)
+
+
+def file_digest(path):
+  """Return the hex SHA-1 digest of a file's contents."""
+  sha = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+
+def blob_path(bisect_dir, digest):
+  """Get the path of the blob with the given digest in the object store."""
+  return os.path.join(bisect_dir, BLOB_DIR, digest[:2], digest[2:])
+
+
+def store_blob(bisect_dir, abs_file_path):
+  """Add a file to the content-addressed object store.
+
+  Files whose contents are already in the store are not copied again. New
+  blobs are copied to a temporary file and renamed into place so concurrent
+  writers of the same content never expose a partial blob.
+
+  Returns:
+    Tuple of (digest, size) for the stored blob.
+  """
+  digest = file_digest(abs_file_path)
+  path = blob_path(bisect_dir, digest)
+  if not os.path.exists(path):
+    import tempfile
+    blob_dir = os.path.dirname(path)
+    makedirs(blob_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=blob_dir, prefix='.tmp')
+    os.close(fd)
+    try:
+      copy_file(bisect_dir, abs_file_path, tmp_path)
+      os.rename(tmp_path, path)
+    except:
+      os.remove(tmp_path)
+      raise
+  return digest, os.path.getsize(path)
+
+
+def link_blob(bisect_dir, blob, dest_path):
+  """Make dest_path refer to blob, hardlinking when possible."""
+  if os.path.lexists(dest_path):
+    os.remove(dest_path)
+  try:
+    os.link(blob, dest_path)
+  except OSError:
+    copy_file(bisect_dir, blob, dest_path)
+
+
+def read_manifest(bisect_dir, cache):
+  """Read a population's manifest.
+
+  Returns:
+    Dictionary mapping each cached path to a (digest, size) tuple. Later
+    entries for the same path override earlier ones.
+  """
+  manifest = {}
+  manifest_path = os.path.join(bisect_dir, cache, MANIFEST_FILE)
+  if not os.path.exists(manifest_path):
+    return manifest
+  with lock_file(manifest_path, 'r') as manifest_file:
+    for line in manifest_file:
+      digest, size, path = line.rstrip('\n').split(' ', 2)
+      manifest[path] = (digest, int(size))
+  return manifest
+
+
+def cache_file(execargs, bisect_dir, cache, abs_file_path, src_path=None):
+  """Cache compiler output file (.o/.d/.dwo).
+
+  The contents go to the shared object store and the population's copy under
+  bisect_dir/cache is a hardlink to the blob, so outputs that are identical
+  between the good and bad populations only take space once. They are read
+  from src_path if given, e.g. a snapshot taken by stage_outputs.
+
+  Returns:
+    List of shard records (see append_shard) for the populate log and the
+    manifest.
+  """
   # os.path.join fails with absolute paths, use + instead
   bisect_path = os.path.join(bisect_dir, cache) + abs_file_path
   bisect_path_dir = os.path.dirname(bisect_path)
   makedirs(bisect_path_dir)
-  pop_log = os.path.join(bisect_dir, cache, '_POPULATE_LOG')
-  log_to_file(pop_log, execargs, abs_file_path, bisect_path)
+  records = [
+      'G cd: %s; %s\n' % (os.getcwd(), ' '.join(execargs)),
+      'G %s -> %s\n' % (abs_file_path, bisect_path),
+  ]
 
+  if src_path is None:
+    src_path = abs_file_path
   try:
-    if os.path.exists(abs_file_path):
-      shutil.copy2(abs_file_path, bisect_path)
+    if os.path.exists(src_path):
+      digest, size = store_blob(bisect_dir, src_path)
+      link_blob(bisect_dir, blob_path(bisect_dir, digest), bisect_path)
+      records.append('M %s %d %s\n' % (digest, size, abs_file_path))
   except Exception:
     print('Could not cache file %s' % abs_file_path, file=sys.stderr)
     raise
+  return records
+
+
+def _append(path, data):
+  """Append data to path with a single O_APPEND write."""
+  fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  try:
+    os.write(fd, data)
+  finally:
+    os.close(fd)
+
+
+def append_to_list(bisect_dir, cache, obj_path):
+  """Add an object to a population's _LIST and to its digest log.
+
+  Both get a single O_APPEND write, so concurrent compiles need no lock and
+  the list is complete as soon as the populate build is.
+  """
+  list_path = os.path.join(bisect_dir, cache, '_LIST')
+  _append(list_path, _to_bytes(obj_path + '\n'))
+  _append(list_path + DIGEST_LOG_SUFFIX, path_digest(obj_path))
+
+
+def _same_file(fd, path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return False
+  fst = os.fstat(fd)
+  return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+def append_shard(bisect_dir, cache, records):
+  """Append one compile's records to this host's shard.
+
+  Records are lines tagged 'M' (manifest entry) or 'G' (populate log line).
+  They are written as a single block, terminated by SHARD_BLOCK_END, with one
+  O_APPEND write so concurrent writers never interleave. The block starts with
+  a 'T' record holding the time of the write, which finalize_population
+  merges the blocks by.
+
+  Writers hold a shared lock on the shard while they write, which does not
+  serialize them but lets finalize_population wait for the writes into a
+  shard it renamed. A writer that finds its shard renamed retries with a new
+  one.
+  """
+  shard_dir = os.path.join(bisect_dir, cache, SHARD_DIR)
+  shard_path = os.path.join(shard_dir, _hostname())
+  stamp = 'T %.6f\n' % time.time()
+  data = _to_bytes(stamp + ''.join(records) + SHARD_BLOCK_END)
+  while True:
+    try:
+      makedirs(shard_dir)
+      fd = os.open(shard_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    except OSError as e:
+      # finalize_population removed the shard dir after merging.
+      if e.errno not in (errno.ENOENT, errno.EEXIST):
+        raise
+      continue
+    try:
+      fcntl.lockf(fd, fcntl.LOCK_SH)
+      if _same_file(fd, shard_path):
+        os.write(fd, data)
+        return
+    finally:
+      # Closing the file releases the lock.
+      os.close(fd)
+
+
+def _read_shard_blocks(shard_path):
+  """Read the complete record blocks from a shard file."""
+  with open(shard_path, 'rb') as shard:
+    data = shard.read()
+  if not isinstance(data, str):
+    data = data.decode('utf-8')
+  blocks = []
+  block = []
+  for line in data.splitlines(True):
+    if line == SHARD_BLOCK_END:
+      blocks.append(tuple(block))
+      block = []
+    else:
+      block.append(line)
+  # A trailing unterminated block was never completely written, drop it.
+  return blocks
+
+
+def _block_order(block):
+  """Sort key merging shard blocks in the order they were written.
+
+  Blocks written at the same time are ordered by their contents, so the
+  result does not depend on which host or process wrote them. Blocks from
+  shards that predate the 'T' records sort first.
+  """
+  stamp = 0.0
+  if block and block[0].startswith('T '):
+    stamp = float(block[0].split()[1])
+  return stamp, block
+
+
+def finalize_population(bisect_dir, cache):
+  """Merge a population's shards into the populate log and the manifest.
+
+  Blocks from all shards are merged in the order they were written, so a
+  path cached more than once ends up with the manifest entry of its last
+  compile. This relies on the clocks of hosts sharing a bisect dir being in
+  sync. Finalizing a population without shards does nothing.
+  """
+  population_dir = os.path.join(bisect_dir, cache)
+  shard_dir = os.path.join(population_dir, SHARD_DIR)
+  if not os.path.isdir(shard_dir):
+    return
 
+  list_path = os.path.join(population_dir, '_LIST')
+  with lock_file(list_path, 'a'):
+    if not os.path.isdir(shard_dir):
+      # Another process finalized while we waited for the lock.
+      return
+
+    blocks = []
+    merged_shards = []
+    for name in sorted(os.listdir(shard_dir)):
+      shard_path = os.path.join(shard_dir, name)
+      # Move the shard aside, then wait for the writers that opened it before
+      # the rename. Later writers find it gone and write to a new shard, see
+      # append_shard.
+      merged_path = os.path.join(population_dir, '.merging_' + name)
+      os.rename(shard_path, merged_path)
+      with lock_file(merged_path, 'a'):
+        pass
+      merged_shards.append(merged_path)
+      blocks.extend(_read_shard_blocks(merged_path))
+    blocks.sort(key=_block_order)
+
+    records = [record for block in blocks for record in block]
+    with open(os.path.join(population_dir, MANIFEST_FILE), 'a') as manifest:
+      manifest.writelines(r[2:] for r in records if r.startswith('M '))
+    with open(os.path.join(population_dir, POPULATE_LOG), 'a') as pop_log:
+      pop_log.writelines(r[2:] for r in records if r.startswith('G '))
+
+    for merged_path in merged_shards:
+      os.remove(merged_path)
+    try:
+      os.rmdir(shard_dir)
+    except OSError:
+      # New shards appeared during the merge, the next finalize takes them.
+      pass
 
-def restore_file(bisect_dir, cache, abs_file_path):
-  """Restore file from cache (.o/.d/.dwo)."""
+
+def restore_file(bisect_dir, cache, abs_file_path, link=True):
+  """Restore file from cache (.o/.d/.dwo).
+
+  Cached files are hardlinks into the object store, so linking the cached
+  path links the shared blob. With link=False the file is restored as a copy
+  on its own inode, with the current time as its mtime, which can be touched
+  without changing the blob.
+  """
   # os.path.join fails with absolute paths, use + instead
   cached_path = os.path.join(bisect_dir, cache) + abs_file_path
-  if os.path.exists(cached_path):
-    if os.path.exists(abs_file_path):
-      os.remove(abs_file_path)
+  if not os.path.exists(cached_path):
+    raise Error(('%s is missing from %s cache! Unsure how to proceed. Make '
+                 'will now crash.' % (cache, cached_path)))
+
+  if os.path.exists(abs_file_path):
+    os.remove(abs_file_path)
+  if link:
     try:
       os.link(cached_path, abs_file_path)
+      return
     except OSError:
-      shutil.copyfile(cached_path, abs_file_path)
-  else:
-    raise Error(('%s is missing from %s cache! Unsure how to proceed. Make '
-                 'will now crash.' % (cache, cached_path)))
+      pass
+  copy_file(bisect_dir, cached_path, abs_file_path, copy_stat=False)
+
+
+def cache_outputs(execargs, bisect_dir, population_name, full_obj_path,
+                  staged=None):
+  """Cache an object file and its side effects and record them in a shard.
+
+  staged maps the outputs to the snapshots to read them from, see
+  stage_outputs.
+  """
+  staged = staged or {}
+  records = cache_file(execargs, bisect_dir, population_name, full_obj_path,
+                       staged.get(full_obj_path))
+
+  for side_effect in get_side_effects(execargs):
+    records += cache_file(execargs, bisect_dir, population_name, side_effect,
+                          staged.get(side_effect))
+
+  append_shard(bisect_dir, population_name, records)
+  append_to_list(bisect_dir, population_name, full_obj_path)
+
+
+def stage_outputs(bisect_dir, population_name, paths):
+  """Snapshot compiler outputs so they can be cached after the compile.
+
+  Make or ninja may delete or rewrite outputs as soon as the compile returns,
+  e.g. ninja deletes the depfiles it reads with deps = gcc. Each existing path
+  is hardlinked, or copied if that fails, into a new private directory under
+  STAGING_DIR.
+
+  Returns:
+    Tuple of the staging directory and a dict mapping each of paths to its
+    snapshot. The snapshots of paths that do not exist do not exist either.
+  """
+  import tempfile
+  staging_root = os.path.join(bisect_dir, population_name, STAGING_DIR)
+  makedirs(staging_root)
+  staging_dir = tempfile.mkdtemp(
+      dir=staging_root, prefix=_hostname() + '.')
+  staged = {}
+  try:
+    for i, path in enumerate(paths):
+      staged[path] = os.path.join(staging_dir, str(i))
+      if not os.path.exists(path):
+        continue
+      try:
+        os.link(path, staged[path])
+      except OSError:
+        copy_file(bisect_dir, path, staged[path])
+  except:
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    raise
+  return staging_dir, staged
+
+
+def cache_outputs_in_background(execargs, bisect_dir, population_name,
+                                full_obj_path):
+  """Run cache_outputs in a detached child so the compile returns at once.
+
+  The outputs are snapshotted before forking, so the child only has to hash
+  and store them. A pending marker holding the child's pid, named like the
+  staging directory, is created before forking as well. The child removes
+  both once the outputs are cached and the shard records are written, or
+  moves the marker to FAILED_DIR with the error if caching fails.
+  flush_population waits for all markers to go away.
+  """
+  population_dir = os.path.join(bisect_dir, population_name)
+  staging_dir, staged = stage_outputs(
+      bisect_dir, population_name, [full_obj_path] + get_side_effects(execargs))
+  pending_dir = os.path.join(population_dir, PENDING_DIR)
+  marker = os.path.join(pending_dir, os.path.basename(staging_dir))
+  try:
+    makedirs(pending_dir)
+    fd = os.open(marker, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+  except:
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    raise
+
+  pid = os.fork()
+  if pid:
+    os.write(fd, _to_bytes(str(pid)))
+    os.close(fd)
+    return
+
+  # Detach from Make: a child holding the compile's stdout/stderr open would
+  # keep Make (or ninja) waiting for the job anyway.
+  os.close(fd)
+  os.setsid()
+  devnull = os.open(os.devnull, os.O_RDWR)
+  for std_fd in (0, 1, 2):
+    os.dup2(devnull, std_fd)
+  try:
+    try:
+      cache_outputs(execargs, bisect_dir, population_name, full_obj_path,
+                    staged)
+    finally:
+      shutil.rmtree(staging_dir, ignore_errors=True)
+  except:
+    import traceback
+    with open(marker, 'a') as f:
+      f.write('\n%s: %s' % (full_obj_path, traceback.format_exc()))
+    failed_dir = os.path.join(population_dir, FAILED_DIR)
+    makedirs(failed_dir)
+    os.rename(marker, os.path.join(failed_dir, os.path.basename(marker)))
+    os._exit(1)
+  os.remove(marker)
+  os._exit(0)
 
 
 def bisect_populate(execargs, bisect_dir, population_name):
@@ -257,10 +947,16 @@ def bisect_populate(execargs, bisect_dir, population_name):
   includes copying the created object file, adding the object
   file path to the cache list and keeping a log of the execution.
 
+  With BISECT_ASYNC_POPULATE=1 the caching happens in a background process
+  and the population is only complete after 'bisect_driver.py flush'.
+
   Args:
     execargs: compiler execution arguments.
     bisect_dir: bisection directory.
     population_name: name of the cache being populated (good/bad).
+
+  Returns:
+    The exit status of the compiler.
   """
   retval = exec_and_return(execargs)
   if retval:
@@ -269,16 +965,196 @@ def bisect_populate(execargs, bisect_dir, population_name):
   full_obj_path = get_obj_path(execargs)
   # If not a normal compiler call then just exit
   if not full_obj_path:
+    return retval
+
+  clear_flushed(bisect_dir, population_name)
+  if ASYNC_POPULATE:
+    cache_outputs_in_background(execargs, bisect_dir, population_name,
+                                full_obj_path)
+  else:
+    cache_outputs(execargs, bisect_dir, population_name, full_obj_path)
+  return retval
+
+
+def _writer_alive(marker):
+  """Check whether the background writer owning a pending marker runs."""
+  age = time.time() - os.path.getmtime(marker)
+  host = os.path.basename(marker).split('.', 1)[0]
+  if host != _hostname().split('.', 1)[0]:
+    # Writers on other hosts cannot be checked, assume they are running
+    # unless they would have outlived a flush.
+    return age < FLUSH_TIMEOUT
+  with open(marker) as f:
+    pid = f.read().strip()
+  if not pid:
+    # The parent may not have recorded the pid yet.
+    return age < PID_GRACE
+  try:
+    os.kill(int(pid), 0)
+  except OSError as e:
+    return e.errno != errno.ESRCH
+  return True
+
+
+def failed_writers(bisect_dir, cache):
+  """Return the markers of background writers that failed to cache."""
+  failed_dir = os.path.join(bisect_dir, cache, FAILED_DIR)
+  if not os.path.isdir(failed_dir):
+    return []
+  return [os.path.join(failed_dir, name)
+          for name in sorted(os.listdir(failed_dir))]
+
+
+def flush_population(bisect_dir, cache, timeout=FLUSH_TIMEOUT):
+  """Wait for background writers of a population and finalize it.
+
+  Writers whose process disappeared without removing their marker are
+  recorded as failed.
+
+  Returns:
+    List of failed writer markers, see failed_writers.
+  """
+  population_dir = os.path.join(bisect_dir, cache)
+  pending_dir = os.path.join(population_dir, PENDING_DIR)
+  deadline = time.time() + timeout
+  while os.path.isdir(pending_dir):
+    pending = []
+    for name in os.listdir(pending_dir):
+      marker = os.path.join(pending_dir, name)
+      try:
+        alive = _writer_alive(marker)
+      except IOError:
+        # Finished while we were looking at it.
+        continue
+      if alive:
+        pending.append(marker)
+      else:
+        failed_dir = os.path.join(population_dir, FAILED_DIR)
+        makedirs(failed_dir)
+        os.rename(marker, os.path.join(failed_dir, name))
+        shutil.rmtree(os.path.join(population_dir, STAGING_DIR, name),
+                      ignore_errors=True)
+
+    if not pending:
+      try:
+        os.rmdir(pending_dir)
+      except OSError:
+        # A new writer started, keep waiting.
+        continue
+      break
+    if time.time() > deadline:
+      raise Error('%d background cache writers for %s still running after '
+                  '%d seconds' % (len(pending), cache, timeout))
+    time.sleep(0.1)
+
+  finalize_population(bisect_dir, cache)
+  return failed_writers(bisect_dir, cache)
+
+
+def ensure_flushed(bisect_dir, cache):
+  """Flush a population unless it was flushed since it was last populated.
+
+  Only the first triage compile pays for the flush, concurrent ones wait for
+  it to finish.
+
+  Raises:
+    Error if background writers failed: their objects are not in the cache.
+  """
+  population_dir = os.path.join(bisect_dir, cache)
+  flushed_path = os.path.join(population_dir, FLUSHED_FILE)
+  if os.path.exists(flushed_path) or not os.path.isdir(population_dir):
     return
+  with lock_file(os.path.join(population_dir, FLUSH_LOCK), 'a'):
+    if os.path.exists(flushed_path):
+      return
+    failed = flush_population(bisect_dir, cache)
+    if failed:
+      raise Error('%d background cache writers for %s failed, see %s' %
+                  (len(failed), cache, ' '.join(failed)))
+    open(flushed_path, 'w').close()
+
+
+def clear_flushed(bisect_dir, cache):
+  """Mark a population as needing a flush before the next triage."""
+  try:
+    os.remove(os.path.join(bisect_dir, cache, FLUSHED_FILE))
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
 
-  cache_file(execargs, bisect_dir, population_name, full_obj_path)
 
-  population_dir = os.path.join(bisect_dir, population_name)
-  with lock_file(os.path.join(population_dir, '_LIST'), 'a') as object_list:
-    object_list.write('%s\n' % full_obj_path)
+def logged_side_effects(bisect_dir):
+  """Map the objects of both populations to the side effects of their compile.
 
-  for side_effect in get_side_effects(execargs):
-    cache_file(execargs, bisect_dir, population_name, side_effect)
+  The side effects are found from the compile commands in the populate logs.
+  """
+  side_effects = {}
+  for cache in (GOOD_CACHE, BAD_CACHE):
+    log_path = os.path.join(bisect_dir, cache, POPULATE_LOG)
+    if not os.path.exists(log_path):
+      continue
+    last_command = None
+    with open(log_path) as pop_log:
+      for line in pop_log:
+        # Every output of a compile is logged after the same command.
+        if not line.startswith('cd: ') or line == last_command:
+          continue
+        last_command = line
+        cwd, command = line[len('cd: '):].rstrip('\n').split('; ', 1)
+        execargs = command.split(' ')
+        obj_path = get_obj_path(execargs, cwd)
+        if obj_path:
+          side_effects[obj_path] = get_side_effects(execargs, cwd)
+  return side_effects
+
+
+def logged_outputs(bisect_dir, cache):
+  """Return the paths of the outputs a population's populate log records.
+
+  This includes the side effects, which triage restores too.
+  """
+  log_path = os.path.join(bisect_dir, cache, POPULATE_LOG)
+  if not os.path.exists(log_path):
+    return []
+  outputs = []
+  with open(log_path) as pop_log:
+    for line in pop_log:
+      if not line.startswith('cd: ') and ' -> ' in line:
+        outputs.append(line.split(' -> ', 1)[0])
+  return outputs
+
+
+def verify_population(bisect_dir, cache):
+  """Check that every output of a population reached the cache.
+
+  The outputs are the listed objects, the files in the populate log,
+  including the side effects, and the manifest entries.
+
+  Returns:
+    List of problem descriptions, empty if the population is complete.
+  """
+  problems = ['background cache writer failed, see %s' % marker
+              for marker in failed_writers(bisect_dir, cache)]
+  list_path = os.path.join(bisect_dir, cache, '_LIST')
+  listed = []
+  if os.path.exists(list_path):
+    with lock_file(list_path, 'r') as object_list:
+      listed = [line.rstrip('\n') for line in object_list]
+
+  manifest = read_manifest(bisect_dir, cache)
+  outputs = set(listed) | set(logged_outputs(bisect_dir, cache)) | set(manifest)
+  for path in sorted(outputs):
+    if path not in manifest:
+      problems.append('%s has no %s manifest entry' % (path, cache))
+      continue
+    digest, size = manifest[path]
+    blob = blob_path(bisect_dir, digest)
+    if not os.path.exists(blob) or os.path.getsize(blob) != size:
+      problems.append('%s blob %s is missing or truncated' % (path, digest))
+    # os.path.join fails with absolute paths, use + instead
+    if not os.path.exists(os.path.join(bisect_dir, cache) + path):
+      problems.append('%s is missing from the %s cache' % (path, cache))
+  return problems
 
 
 def bisect_triage(execargs, bisect_dir):
@@ -289,9 +1165,20 @@ def bisect_triage(execargs, bisect_dir):
   if not full_obj_path:
     return exec_and_return(execargs)
 
+  # The first triage compile merges whatever the populate steps left behind.
+  for cache in (GOOD_CACHE, BAD_CACHE):
+    ensure_flushed(bisect_dir, cache)
+
+  # Let a running triage daemon answer both questions in one round trip.
+  cache = query_daemon(bisect_dir, full_obj_path)
+  if cache is None:
+    known = in_object_list(full_obj_path, obj_list)
+  else:
+    known = cache != MISSING
+
   # If this isn't a bisected object just call compiler
   # This shouldn't happen!
-  if not in_object_list(full_obj_path, obj_list):
+  if not known:
     if CONTINUE_ON_MISSING:
       log_file = os.path.join(bisect_dir, '_MISSING_CACHED_OBJ_LOG')
       log_to_file(log_file, execargs, '? compiler', full_obj_path)
@@ -301,7 +1188,8 @@ def bisect_triage(execargs, bisect_dir):
                    'BISECT_CONTINUE_ON_MISSING=1. See documentation for more '
                    'details on this option.' % full_obj_path))
 
-  cache = which_cache(full_obj_path)
+  if cache is None:
+    cache = which_cache(full_obj_path, bisect_dir)
 
   # If using safe WRAPPER_SAFE_MODE option call compiler and overwrite the
   # result from the good/bad cache. This option is safe and covers all compiler
@@ -312,7 +1200,7 @@ def bisect_triage(execargs, bisect_dir):
       return retval
     os.remove(full_obj_path)
     restore_file(bisect_dir, cache, full_obj_path)
-    return
+    return retval
 
   # Generate compiler side effects. Trick Make into thinking compiler was
   # actually executed.
@@ -323,15 +1211,300 @@ def bisect_triage(execargs, bisect_dir):
   # over from cache again.
   if not os.path.exists(full_obj_path):
     restore_file(bisect_dir, cache, full_obj_path)
+  return 0
+
+
+class TriageLists(object):
+  """Makes triage decisions from the object list and bad sets in memory.
+
+  The good population's _LIST and the current bad set are loaded once and
+  reloaded only when their path, mtime or size change, i.e. once per search
+  iteration. Only the latest list of each kind is kept, so memory does not
+  grow over a bisection. Used by the triage daemon, see serve.
+  """
+
+  def __init__(self, bisect_dir):
+    import threading
+    self.bisect_dir = bisect_dir
+    self._lock = threading.Lock()
+    # Maps 'list' and 'bad' to (_index_key of the list, set of paths).
+    self._path_sets = {}
+
+  def _path_set(self, kind, list_path):
+    key = _index_key(list_path)
+    with self._lock:
+      cached = self._path_sets.get(kind)
+      if cached is None or cached[0] != key:
+        # Drop the previous set before loading the new one.
+        self._path_sets.pop(kind, None)
+        with open(list_path, 'rb') as list_file:
+          paths = set(line.rstrip(b'\n') for line in list_file)
+        cached = (key, paths)
+        self._path_sets[kind] = cached
+      return cached[1]
+
+  def triage(self, bad_set_file, obj_path):
+    obj_list = os.path.join(self.bisect_dir, LIST_FILE)
+    if obj_path not in self._path_set('list', obj_list):
+      return MISSING
+    if obj_path in self._path_set('bad', bad_set_file):
+      return BAD_CACHE
+    return GOOD_CACHE
+
+
+def query_daemon(bisect_dir, obj_path):
+  """Ask a running triage daemon where an object should be restored from.
+
+  Returns:
+    GOOD_CACHE, BAD_CACHE or MISSING, or None if no daemon is serving the
+    bisect dir, in which case the caller falls back to the on-disk indexes.
+  """
+  socket_path = os.path.join(bisect_dir, DAEMON_SOCKET)
+  if not os.path.exists(socket_path):
+    return None
+
+  import socket
+  bad_set_file = os.path.abspath(os.environ.get('BISECT_BAD_SET'))
+  request = _to_bytes(bad_set_file) + b'\0' + _to_bytes(obj_path)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.settimeout(DAEMON_TIMEOUT)
+  try:
+    sock.connect(socket_path)
+    sock.sendall(request + b'\n')
+    reply = b''
+    while not reply.endswith(b'\n'):
+      chunk = sock.recv(64)
+      if not chunk:
+        return None
+      reply += chunk
+  except (socket.error, socket.timeout):
+    return None
+  finally:
+    sock.close()
+  return str(reply.strip().decode('ascii'))
+
+
+def serve(bisect_dir):
+  """Run the triage daemon for bisect_dir until interrupted or terminated."""
+  import signal
+  import socket
+  try:
+    import socketserver
+  except ImportError:
+    import SocketServer as socketserver
+
+  class TriageHandler(socketserver.StreamRequestHandler):
+    """Answers triage requests, one per line, until the client disconnects.
+
+    A request is the absolute bad set path and object path separated by a NUL
+    byte. The reply is the name of the cache to restore from, or MISSING.
+    """
+
+    def handle(self):
+      for line in self.rfile:
+        bad_set_file, obj_path = line.rstrip(b'\n').split(b'\0', 1)
+        answer = lists.triage(bad_set_file, obj_path)
+        self.wfile.write(answer.encode('ascii') + b'\n')
+        self.wfile.flush()
+
+  class TriageServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+  socket_path = os.path.join(bisect_dir, DAEMON_SOCKET)
+  if os.path.exists(socket_path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(socket_path)
+    except socket.error:
+      # Left behind by a daemon that did not shut down cleanly.
+      os.remove(socket_path)
+    else:
+      raise Error('A triage daemon is already serving %s' % bisect_dir)
+    finally:
+      probe.close()
+
+  lists = TriageLists(bisect_dir)
+  server = TriageServer(socket_path, TriageHandler)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  print('bisect: triage daemon listening on %s' % socket_path, file=sys.stderr)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    os.remove(socket_path)
 
 
 def bisect_driver(bisect_stage, bisect_dir, execargs):
-  """Call appropriate bisection stage according to value in bisect_stage."""
+  """Call appropriate bisection stage according to value in bisect_stage.
+
+  Returns:
+    The exit status of the compiler, 0 if it did not have to run. It is
+    negative if the compiler was killed by a signal.
+  """
   if bisect_stage == 'POPULATE_GOOD':
-    bisect_populate(execargs, bisect_dir, GOOD_CACHE)
+    return bisect_populate(execargs, bisect_dir, GOOD_CACHE)
   elif bisect_stage == 'POPULATE_BAD':
-    bisect_populate(execargs, bisect_dir, BAD_CACHE)
+    return bisect_populate(execargs, bisect_dir, BAD_CACHE)
   elif bisect_stage == 'TRIAGE':
-    bisect_triage(execargs, bisect_dir)
+    return bisect_triage(execargs, bisect_dir)
   else:
     raise ValueError('wrong value for BISECT_STAGE: %s' % bisect_stage)
+
+
+def dedup_stats(bisect_dir):
+  """Summarize how much the object store saves across both populations.
+
+  Returns:
+    Tuple of (cached files, unique blobs, logical bytes, stored bytes).
+  """
+  files = 0
+  logical_bytes = 0
+  blobs = {}
+  for cache in (GOOD_CACHE, BAD_CACHE):
+    for digest, size in read_manifest(bisect_dir, cache).values():
+      files += 1
+      logical_bytes += size
+      blobs[digest] = size
+  return files, len(blobs), logical_bytes, sum(blobs.values())
+
+
+def print_stats(bisect_dir):
+  """Print bisect cache statistics, run after POPULATE_BAD completes."""
+  for cache in (GOOD_CACHE, BAD_CACHE):
+    flush_population(bisect_dir, cache)
+  files, unique, logical_bytes, stored_bytes = dedup_stats(bisect_dir)
+  ratio = float(logical_bytes) / stored_bytes if stored_bytes else 1.0
+  print('%d cached files, %d unique blobs' % (files, unique))
+  print('%d bytes cached, %d bytes stored, %d bytes saved (dedup ratio %.2f)' %
+        (logical_bytes, stored_bytes, logical_bytes - stored_bytes, ratio))
+  strategy = read_copy_strategy(bisect_dir)
+  if strategy:
+    print('copy strategy %s (%.1f MB/s)' % (strategy[0],
+                                             strategy[1] / (1 << 20)))
+
+
+def benchmark_which_cache(sizes, lookups):
+  """Compare which_cache with a grep -x -q per lookup on bad sets of sizes.
+
+  Returns:
+    List of (entries, grep seconds per lookup, index build seconds, index
+    seconds per lookup) tuples.
+  """
+  import tempfile
+  results = []
+  old_bad_set = os.environ.get('BISECT_BAD_SET')
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    for size in sizes:
+      bad_set_file = os.path.join(tmp_dir, 'bad_set_%d' % size)
+      paths = ['/out/obj/dir%d/file%d.o' % (i % 1000, i) for i in range(size)]
+      with open(bad_set_file, 'w') as bad_set:
+        bad_set.writelines(path + '\n' for path in paths)
+      # Half of the probes hit, half miss.
+      probes = [paths[i * size // lookups] if i % 2 else '/missing%d.o' % i
+                for i in range(lookups)]
+      os.environ['BISECT_BAD_SET'] = bad_set_file
+
+      grep_probes = probes[:max(2, lookups // 50)]
+      start = time.time()
+      for probe in grep_probes:
+        subprocess.call(['grep', '-x', '-q', probe, bad_set_file])
+      grep_time = (time.time() - start) / len(grep_probes)
+
+      # The first lookup builds the index.
+      start = time.time()
+      which_cache(probes[0], tmp_dir)
+      build_time = time.time() - start
+      start = time.time()
+      for probe in probes:
+        which_cache(probe, tmp_dir)
+      lookup_time = (time.time() - start) / len(probes)
+      results.append((size, grep_time, build_time, lookup_time))
+  finally:
+    if old_bad_set is None:
+      os.environ.pop('BISECT_BAD_SET', None)
+    else:
+      os.environ['BISECT_BAD_SET'] = old_bad_set
+    shutil.rmtree(tmp_dir)
+  return results
+
+
+def print_benchmark(results):
+  print('%9s %12s %12s %12s %9s' % ('entries', 'grep/lookup', 'index build',
+                                    'index/lookup', 'speedup'))
+  for size, grep_time, build_time, lookup_time in results:
+    print('%9d %10.3fms %10.1fms %10.3fms %8.0fx' %
+          (size, 1000 * grep_time, 1000 * build_time, 1000 * lookup_time,
+           grep_time / lookup_time))
+
+
+def main(argv):
+  import argparse
+  parser = argparse.ArgumentParser(
+      description='Maintenance commands for the bisection caches.')
+  parser.add_argument(
+      '--bisect-dir',
+      default=os.environ.get('BISECT_DIR') or
+      os.path.expanduser('~/ANDROID_BISECT'),
+      help='Bisection directory (defaults to $BISECT_DIR).')
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  subparsers.add_parser(
+      'stats', help='Report cache deduplication statistics.')
+  subparsers.add_parser(
+      'finalize', help='Merge populate shards into the cache lists and logs.')
+  subparsers.add_parser(
+      'flush',
+      help='Wait for background cache writers, then finalize the caches.')
+  subparsers.add_parser(
+      'verify',
+      help='Check that every object and side effect reached the cache.')
+  subparsers.add_parser(
+      'serve', help='Run a daemon answering TRIAGE lookups over a Unix socket.')
+  benchmark_parser = subparsers.add_parser(
+      'benchmark', help='Compare bad set lookups with grep per object.')
+  benchmark_parser.add_argument(
+      '--sizes',
+      type=int,
+      nargs='+',
+      default=[10000, 100000, 1000000],
+      help='Numbers of bad set entries to measure.')
+  benchmark_parser.add_argument(
+      '--lookups',
+      type=int,
+      default=1000,
+      help='Index lookups per size, grep runs a fiftieth of them.')
+
+  args = parser.parse_args(argv)
+  if args.command == 'stats':
+    print_stats(args.bisect_dir)
+  elif args.command == 'finalize':
+    for cache in (GOOD_CACHE, BAD_CACHE):
+      finalize_population(args.bisect_dir, cache)
+  elif args.command == 'flush':
+    failed = []
+    for cache in (GOOD_CACHE, BAD_CACHE):
+      failed += flush_population(args.bisect_dir, cache)
+    for marker in failed:
+      print('background cache writer failed, see %s' % marker, file=sys.stderr)
+    return 1 if failed else 0
+  elif args.command == 'verify':
+    problems = []
+    for cache in (GOOD_CACHE, BAD_CACHE):
+      flush_population(args.bisect_dir, cache)
+      problems += verify_population(args.bisect_dir, cache)
+    for problem in problems:
+      print(problem, file=sys.stderr)
+    return 1 if problems else 0
+  elif args.command == 'serve':
+    serve(args.bisect_dir)
+  elif args.command == 'benchmark':
+    print_benchmark(benchmark_which_cache(args.sizes, args.lookups))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
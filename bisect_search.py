@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Search for the bad object file using the bisect_driver caches.
+
+Once both POPULATE_GOOD and POPULATE_BAD have run, this drives the search over
+the objects listed in good/_LIST. Each probe picks a set of objects to take
+from the bad cache, writes it to a bad set file and runs the user's test
+script, which must exit with 0 if the result is good and non-zero otherwise.
+
+By default probes reuse the current build tree: only the objects that switch
+caches between probes are restored, together with their .d/.dwo side effects,
+as fresh copies so the build relinks. Then the optional build command and the
+test script run. With --no-restore the
+test script gets the bad set in $BISECT_BAD_SET and is responsible for
+producing the build, e.g. with a TRIAGE build in its own tree. Such probes are
+independent, so --jobs K evaluates K candidate splits at once and each
+iteration narrows the search K-fold instead of in half.
+
+The search assumes a single object is responsible for the failure.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+import bisect_driver
+
+SEARCH_DIR = '_SEARCH'
+
+
+class ObjectSwitcher(object):
+  """Keeps the objects in the build tree in sync with the wanted bad set."""
+
+  def __init__(self, bisect_dir):
+    self.bisect_dir = bisect_dir
+    self.current = {}
+    self.side_effects = bisect_driver.logged_side_effects(bisect_dir)
+
+  def apply(self, objects, bad_set):
+    """Restore every object whose cache differs from the one in place.
+
+    The side effects of the object are restored from the same cache.
+
+    Returns:
+      Number of objects restored.
+    """
+    restored = 0
+    for obj_path in objects:
+      cache = (bisect_driver.BAD_CACHE
+               if obj_path in bad_set else bisect_driver.GOOD_CACHE)
+      if self.current.get(obj_path) == cache:
+        continue
+      # Restore copies rather than links to the shared blobs: a copy has a
+      # new mtime, so the build relinks, without touching the other links.
+      for path in [obj_path] + self.side_effects.get(obj_path, []):
+        bisect_driver.restore_file(self.bisect_dir, cache, path, link=False)
+      self.current[obj_path] = cache
+      restored += 1
+    return restored
+
+
+class Prober(object):
+  """Runs one build/test probe per bad set."""
+
+  def __init__(self, bisect_dir, objects, test_script, build_cmd=None,
+               restore=True):
+    self.bisect_dir = bisect_dir
+    self.objects = objects
+    self.test_script = test_script
+    self.build_cmd = build_cmd
+    self.switcher = ObjectSwitcher(bisect_dir) if restore else None
+    self.search_dir = os.path.join(bisect_dir, SEARCH_DIR)
+    self._lock = threading.Lock()
+    self._next_id = 0
+    bisect_driver.makedirs(self.search_dir)
+
+  def _new_bad_set_file(self, bad_set):
+    with self._lock:
+      probe_id = self._next_id
+      self._next_id += 1
+    path = os.path.join(self.search_dir, 'bad_set.%d' % probe_id)
+    with open(path, 'w') as f:
+      f.writelines('%s\n' % obj_path for obj_path in sorted(bad_set))
+    return path
+
+  def is_bad(self, bad_objects):
+    """Check whether taking bad_objects from the bad cache fails the test."""
+    bad_set = set(bad_objects)
+    env = dict(os.environ)
+    env['BISECT_DIR'] = self.bisect_dir
+    env['BISECT_STAGE'] = 'TRIAGE'
+    env['BISECT_BAD_SET'] = self._new_bad_set_file(bad_set)
+
+    if self.switcher:
+      restored = self.switcher.apply(self.objects, bad_set)
+      print('Restored %d objects' % restored)
+    if self.build_cmd:
+      if subprocess.call(self.build_cmd, shell=True, env=env):
+        print('Build failed, counting the probe as bad')
+        return True
+    return subprocess.call([self.test_script], env=env) != 0
+
+
+def split(objects, parts):
+  """Split objects into at most parts contiguous, non-empty chunks."""
+  parts = min(parts, len(objects))
+  size, extra = divmod(len(objects), parts)
+  chunks = []
+  start = 0
+  for i in range(parts):
+    end = start + size + (1 if i < extra else 0)
+    chunks.append(objects[start:end])
+    start = end
+  return chunks
+
+
+def search(objects, prober, jobs=1):
+  """Narrow objects down to the one whose bad version fails the test.
+
+  With jobs == 1 this is a binary search. Otherwise each iteration probes
+  jobs chunks in parallel and keeps the first failing one.
+
+  Returns:
+    The bad object.
+  """
+  pool = ThreadPool(jobs) if jobs > 1 else None
+  try:
+    if pool:
+      all_bad, all_good = pool.map(prober.is_bad, [objects, []])
+    else:
+      all_bad, all_good = prober.is_bad(objects), prober.is_bad([])
+    if all_good:
+      raise bisect_driver.Error('The test fails with every object good')
+    if not all_bad:
+      raise bisect_driver.Error('The test passes with every object bad')
+
+    candidates = objects
+    iteration = 0
+    while len(candidates) > 1:
+      iteration += 1
+      print('Iteration %d: %d candidates' % (iteration, len(candidates)))
+      if pool:
+        chunks = split(candidates, jobs)
+        results = pool.map(prober.is_bad, chunks)
+        failing = [chunk for chunk, bad in zip(chunks, results) if bad]
+        if not failing:
+          raise bisect_driver.Error(
+              'No single chunk reproduces the failure, it needs bad objects '
+              'from several of: %s' % ' '.join(candidates))
+        candidates = failing[0]
+      else:
+        lower, upper = split(candidates, 2)
+        candidates = lower if prober.is_bad(lower) else upper
+
+    if not prober.is_bad(candidates):
+      raise bisect_driver.Error(
+          '%s alone does not reproduce the failure, it needs several bad '
+          'objects' % candidates[0])
+    return candidates[0]
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(
+      description='Find the object file that breaks the build or test.')
+  parser.add_argument(
+      '--bisect-dir',
+      default=os.environ.get('BISECT_DIR') or
+      os.path.expanduser('~/ANDROID_BISECT'),
+      help='Bisection directory (defaults to $BISECT_DIR).')
+  parser.add_argument(
+      '--test-script',
+      required=True,
+      help='Script exiting with 0 when the result is good.')
+  parser.add_argument(
+      '--build-cmd',
+      help='Shell command rebuilding the result after objects are restored.')
+  parser.add_argument(
+      '--no-restore',
+      action='store_false',
+      dest='restore',
+      help='Do not restore objects in place; the test script builds from '
+      '$BISECT_BAD_SET itself.')
+  parser.add_argument(
+      '-j',
+      '--jobs',
+      type=int,
+      default=1,
+      help='Number of probes to run in parallel (requires --no-restore).')
+  args = parser.parse_args(argv)
+  if args.jobs > 1 and args.restore:
+    parser.error('--jobs needs --no-restore, probes share one build tree')
+  return args
+
+
+def main(argv):
+  args = parse_args(argv)
+  for cache in (bisect_driver.GOOD_CACHE, bisect_driver.BAD_CACHE):
+    bisect_driver.ensure_flushed(args.bisect_dir, cache)
+
+  list_path = os.path.join(args.bisect_dir, bisect_driver.LIST_FILE)
+  with open(list_path) as object_list:
+    objects = sorted(set(line.rstrip('\n') for line in object_list))
+
+  prober = Prober(args.bisect_dir, objects, os.path.abspath(args.test_script),
+                  args.build_cmd, args.restore)
+  bad_object = search(objects, prober, args.jobs)
+  print('Bad object: %s' % bad_object)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -17,20 +17,66 @@
 
 import argparse
 import datetime
+import functools
 import glob
+import hashlib
+import json
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
+import py_compile
 import shutil
 import subprocess
+import sys
+import threading
 import utils
 
 import android_version
+import archive
+import build_trace
+import elf
+import scheduler
 from version import Version
 
 import mapfile
 
 ORIG_ENV = dict(os.environ)
 STAGE2_TARGETS = 'AArch64;ARM;BPF;Mips;X86'
+# Runtime builds running at once. Each asks for an equal share of the CPU
+# budget for ninja; cmake configure is mostly single-threaded.
+RUNTIME_WORKERS = 6
+# Arches whose asan runtime gets a version script listing its symbols.
+ASAN_MAP_ARCHES = ('aarch64', 'arm', 'i686', 'x86_64', 'mips', 'mips64')
+_INSTALL_LOCK = threading.Lock()
+# CPU slots shared by every cmake and ninja invocation, and the load average
+# above which ninja starts no new jobs. See set_cpu_budget.
+_CPU_BUDGET = scheduler.CpuBudget(multiprocessing.cpu_count())
+_LOAD_AVERAGE = None
+# invoke_cmake skips configuring a build dir whose inputs match the
+# fingerprint it stored there, unless _RECONFIGURE is set.
+CONFIGURE_FINGERPRINT = 'android-configure.fingerprint'
+_RECONFIGURE = False
+# Memo of source_revisions().
+_SOURCE_REVISIONS = []
+# Source projects of the toolchain, relative to toolchain/.
+LLVM_PROJECTS = (
+    'llvm',
+    'llvm/projects/compiler-rt',
+    'llvm/projects/libcxx',
+    'llvm/projects/libcxxabi',
+    'llvm/projects/openmp',
+    'llvm/tools/clang',
+    'llvm/tools/clang/tools/extra',
+    'llvm/tools/lld',
+)
+# Environment variables that change between shells without affecting cmake.
+VOLATILE_ENV = frozenset([
+    '_', 'COLUMNS', 'DISPLAY', 'LINES', 'LS_COLORS', 'MAIL', 'OLDPWD', 'PS1',
+    'PWD', 'SHLVL', 'SSH_AGENT_PID', 'SSH_AUTH_SOCK', 'SSH_CLIENT',
+    'SSH_CONNECTION', 'SSH_TTY', 'STY', 'TERM', 'TMUX', 'TMUX_PANE',
+    'WINDOWID', 'XDG_RUNTIME_DIR', 'XDG_SESSION_ID'
+])
 
 
 def logger():
@@ -47,9 +93,16 @@ def check_call(cmd, *args, **kwargs):
 
 
 def install_file(src, dst):
-    """Proxy for shutil.copy2 with logging and dry-run support."""
+    """Proxy for shutil.copy2 with logging and dry-run support.
+
+    An existing dst is replaced rather than written through, as it may be a
+    hardlink created by stage_tree.
+    """
     import shutil
     logger().info('copy %s %s', src, dst)
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    utils.remove(dst)
     shutil.copy2(src, dst)
 
 
@@ -181,7 +234,12 @@ def ninja_bin_path():
 
 def check_create_path(path):
     if not os.path.exists(path):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another build step may have created it concurrently.
+            if not os.path.isdir(path):
+                raise
 
 
 def rm_cmake_cache(dir):
@@ -207,7 +265,78 @@ def base_cmake_defines():
     return defines
 
 
-def invoke_cmake(out_path, defines, env, cmake_path, target=None, install=True):
+def set_cpu_budget(jobs, load_average=None):
+    """Caps the jobs of all the cmake and ninja invocations combined."""
+    global _CPU_BUDGET, _LOAD_AVERAGE
+    _CPU_BUDGET = scheduler.CpuBudget(jobs)
+    _LOAD_AVERAGE = load_average
+
+
+def set_reconfigure(reconfigure):
+    """Makes invoke_cmake configure even if the inputs are unchanged."""
+    global _RECONFIGURE
+    _RECONFIGURE = reconfigure
+
+
+def file_identity(path):
+    """Returns the resolved path, size and mtime of a file, or None."""
+    path = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [path, st.st_size, st.st_mtime]
+
+
+def configure_fingerprint(cmake_cmd, defines, env):
+    """Returns a digest of everything a cmake configure depends on.
+
+    This covers the command line, the environment and the cmake and
+    compiler binaries. The sources are not covered: the generated build
+    files re-run cmake when a CMakeLists.txt changes.
+    """
+    tools = [cmake_cmd[0]]
+    for key in ('CMAKE_C_COMPILER', 'CMAKE_CXX_COMPILER', 'CMAKE_ASM_COMPILER'):
+        if key in defines:
+            tools.append(defines[key])
+    inputs = {
+        # Defines come from a dict, their order is irrelevant.
+        'cmd': sorted(cmake_cmd),
+        'env': sorted((key, value) for key, value in env.items()
+                      if key not in VOLATILE_ENV),
+        'tools': [file_identity(tool) for tool in tools],
+    }
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def ninja_cmd(args, jobs):
+    cmd = [ninja_bin_path(), '-j', str(jobs)]
+    if _LOAD_AVERAGE:
+        cmd += ['-l', str(_LOAD_AVERAGE)]
+    return cmd + args
+
+
+def invoke_cmake(out_path, defines, env, cmake_path, target=None, install=True,
+                 jobs=None, clean_cache=False):
+    """Configures, builds and optionally installs a cmake project.
+
+    Configuring is skipped if its inputs are unchanged since the last
+    successful configure of out_path. Otherwise, with clean_cache, the cmake
+    cache of out_path is cleared first.
+
+    ninja runs with up to jobs slots of the CPU budget, or all of them if
+    jobs is None, and with at least one. Configuring and installing take
+    one slot.
+    """
     flags = ['-G', 'Ninja']
 
     # Specify CMAKE_PREFIX_PATH so 'cmake -G Ninja ...' can find the ninja
@@ -220,19 +349,41 @@ def invoke_cmake(out_path, defines, env, cmake_path, target=None, install=True):
     flags += [cmake_path]
 
     check_create_path(out_path)
-    # TODO(srhines): Enable this with a flag, because it forces clean builds
-    # due to the updated cmake generated files.
-    #rm_cmake_cache(out_path)
+    cmake_cmd = [cmake_bin_path()] + flags
+    fingerprint = configure_fingerprint(cmake_cmd, defines, env)
+    fingerprint_path = os.path.join(out_path, CONFIGURE_FINGERPRINT)
+    configured = (not _RECONFIGURE and
+                  os.path.exists(os.path.join(out_path, 'build.ninja')) and
+                  read_file(fingerprint_path) == fingerprint)
 
     if target:
         ninja_target = [target]
     else:
         ninja_target = []
 
-    check_call([cmake_bin_path()] + flags, cwd=out_path, env=env)
-    check_call([ninja_bin_path()] + ninja_target, cwd=out_path, env=env)
+    build_dir = os.path.basename(out_path)
+    if configured:
+        logger().info('Configure inputs of %s unchanged, skipping cmake',
+                      out_path)
+    else:
+        utils.remove(fingerprint_path)
+        if clean_cache:
+            rm_cmake_cache(out_path)
+        with _CPU_BUDGET.reserve(1), build_trace.span(
+                'cmake ' + build_dir, 'cmake', out_path=out_path):
+            check_call(cmake_cmd, cwd=out_path, env=env)
+        with open(fingerprint_path, 'w') as fingerprint_file:
+            fingerprint_file.write(fingerprint)
+    with _CPU_BUDGET.reserve(jobs) as granted, build_trace.span(
+            'ninja ' + build_dir, 'ninja', out_path=out_path, target=target,
+            jobs=jobs):
+        check_call(ninja_cmd(ninja_target, granted), cwd=out_path, env=env)
     if install:
-        check_call([ninja_bin_path(), 'install'], cwd=out_path, env=env)
+        # Runtimes built concurrently install into the same resource
+        # directory, and some of their headers are shared.
+        with _INSTALL_LOCK, _CPU_BUDGET.reserve(1), build_trace.span(
+                'ninja install ' + build_dir, 'ninja', out_path=out_path):
+            check_call(ninja_cmd(['install'], 1), cwd=out_path, env=env)
 
 
 def cross_compile_configs(stage2_install, platform=False):
@@ -337,13 +488,16 @@ def build_asan_test(stage2_install):
         asan_test_bin_path = os.path.join(asan_test_path, 'asan_test')
         open(asan_test_bin_path, 'w+').close()
 
-def build_asan_map_files(stage2_install, clang_version):
+def build_asan_map_files(stage2_install, clang_version, pool):
     lib_dir = os.path.join(stage2_install,
                            clang_resource_dir(clang_version.long_version(), ''))
-    for arch in ('aarch64', 'arm', 'i686', 'x86_64', 'mips', 'mips64'):
+    lib_and_map_files = []
+    for arch in ASAN_MAP_ARCHES:
         lib_file = os.path.join(lib_dir, 'libclang_rt.asan-{}-android.so'.format(arch))
         map_file = os.path.join(lib_dir, 'libclang_rt.asan-{}-android.map.txt'.format(arch))
-        mapfile.create_map_file(lib_file, map_file)
+        lib_and_map_files.append((lib_file, map_file))
+    with _CPU_BUDGET.reserve(len(lib_and_map_files)):
+        mapfile.create_map_files(lib_and_map_files, pool)
 
 def build_libcxx(stage2_install, clang_version):
     for (arch, llvm_triple, libcxx_defines,
@@ -358,14 +512,14 @@ def build_libcxx(stage2_install, clang_version):
         libcxx_env = dict(ORIG_ENV)
 
         libcxx_cmake_path = utils.llvm_path('projects', 'libcxx')
-        rm_cmake_cache(libcxx_path)
 
         invoke_cmake(
             out_path=libcxx_path,
             defines=libcxx_defines,
             env=libcxx_env,
             cmake_path=libcxx_cmake_path,
-            install=False)
+            install=False,
+            clean_cache=True)
         # We need to install libcxx manually.
         install_subdir = clang_resource_dir(clang_version.long_version(),
                                             arch_from_triple(llvm_triple))
@@ -378,107 +532,112 @@ def build_libcxx(stage2_install, clang_version):
                 shutil.copy2(os.path.join(libcxx_libs, f), libcxx_install)
 
 
-def build_crts(stage2_install, clang_version):
+def build_crt(stage2_install, clang_version, config, jobs=None):
+    """Builds and installs compiler-rt for one cross_compile_configs arch."""
+    arch, llvm_triple, crt_defines, cflags = config
     llvm_config = os.path.join(stage2_install, 'bin', 'llvm-config')
-    # Now build compiler-rt for each arch
-    for (arch, llvm_triple, crt_defines,
-         cflags) in cross_compile_configs(stage2_install):
-        logger().info('Building compiler-rt for %s', arch)
-        crt_path = utils.out_path('lib', 'clangrt-' + arch)
-        crt_install = os.path.join(stage2_install, 'lib64', 'clang',
-                                   clang_version.long_version())
-
-        crt_defines['ANDROID'] = '1'
-        crt_defines['LLVM_CONFIG_PATH'] = llvm_config
-        crt_defines['COMPILER_RT_INCLUDE_TESTS'] = 'ON'
-        # FIXME: Disable WError build until upstream fixed the compiler-rt
-        # personality routine warnings caused by r309226.
-        # crt_defines['COMPILER_RT_ENABLE_WERROR'] = 'ON'
-
-        cflags.append('-isystem ' + support_headers())
-
-        crt_defines['CMAKE_C_FLAGS'] = ' '.join(cflags)
-        crt_defines['CMAKE_ASM_FLAGS'] = ' '.join(cflags)
-        crt_defines['CMAKE_CXX_FLAGS'] = ' '.join(cflags)
-        crt_defines['COMPILER_RT_TEST_COMPILER_CFLAGS'] = ' '.join(cflags)
-        crt_defines['COMPILER_RT_TEST_TARGET_TRIPLE'] = llvm_triple
-        crt_defines['COMPILER_RT_INCLUDE_TESTS'] = 'OFF'
-        crt_defines['CMAKE_INSTALL_PREFIX'] = crt_install
-
-        # Build libfuzzer separately.
-        crt_defines['COMPILER_RT_BUILD_LIBFUZZER'] = 'OFF'
-
-        crt_defines['SANITIZER_CXX_ABI'] = 'libcxxabi'
-        if arch == 'arm':
-          crt_defines['SANITIZER_COMMON_LINK_LIBS'] = '-latomic -landroid_support'
-        else:
-          crt_defines['SANITIZER_COMMON_LINK_LIBS'] = '-landroid_support'
+    logger().info('Building compiler-rt for %s', arch)
+    crt_path = utils.out_path('lib', 'clangrt-' + arch)
+    crt_install = os.path.join(stage2_install, 'lib64', 'clang',
+                               clang_version.long_version())
 
-        crt_defines.update(base_cmake_defines())
+    crt_defines['ANDROID'] = '1'
+    crt_defines['LLVM_CONFIG_PATH'] = llvm_config
+    crt_defines['COMPILER_RT_INCLUDE_TESTS'] = 'ON'
+    # FIXME: Disable WError build until upstream fixed the compiler-rt
+    # personality routine warnings caused by r309226.
+    # crt_defines['COMPILER_RT_ENABLE_WERROR'] = 'ON'
 
-        crt_env = dict(ORIG_ENV)
+    cflags.append('-isystem ' + support_headers())
 
-        crt_cmake_path = utils.llvm_path('projects', 'compiler-rt')
-        rm_cmake_cache(crt_path)
-        invoke_cmake(
-            out_path=crt_path,
-            defines=crt_defines,
-            env=crt_env,
-            cmake_path=crt_cmake_path)
+    crt_defines['CMAKE_C_FLAGS'] = ' '.join(cflags)
+    crt_defines['CMAKE_ASM_FLAGS'] = ' '.join(cflags)
+    crt_defines['CMAKE_CXX_FLAGS'] = ' '.join(cflags)
+    crt_defines['COMPILER_RT_TEST_COMPILER_CFLAGS'] = ' '.join(cflags)
+    crt_defines['COMPILER_RT_TEST_TARGET_TRIPLE'] = llvm_triple
+    crt_defines['COMPILER_RT_INCLUDE_TESTS'] = 'OFF'
+    crt_defines['CMAKE_INSTALL_PREFIX'] = crt_install
+
+    # Build libfuzzer separately.
+    crt_defines['COMPILER_RT_BUILD_LIBFUZZER'] = 'OFF'
 
+    crt_defines['SANITIZER_CXX_ABI'] = 'libcxxabi'
+    if arch == 'arm':
+      crt_defines['SANITIZER_COMMON_LINK_LIBS'] = '-latomic -landroid_support'
+    else:
+      crt_defines['SANITIZER_COMMON_LINK_LIBS'] = '-landroid_support'
+
+    crt_defines.update(base_cmake_defines())
+
+    crt_env = dict(ORIG_ENV)
 
-def build_libfuzzers(stage2_install, clang_version, ndk_cxx=False):
+    crt_cmake_path = utils.llvm_path('projects', 'compiler-rt')
+    invoke_cmake(
+        out_path=crt_path,
+        defines=crt_defines,
+        env=crt_env,
+        cmake_path=crt_cmake_path,
+        jobs=jobs,
+        clean_cache=True)
+
+
+def build_libfuzzer(stage2_install, clang_version, config, ndk_cxx=False,
+                    jobs=None):
+    """Builds and installs libFuzzer.a for one cross_compile_configs arch.
+
+    config must come from cross_compile_configs with platform=(not ndk_cxx).
+    """
+    arch, llvm_triple, libfuzzer_defines, cflags = config
     llvm_config = os.path.join(stage2_install, 'bin', 'llvm-config')
+    logger().info('Building libfuzzer for %s (ndk_cxx? %s)', arch, ndk_cxx)
 
-    for (arch, llvm_triple, libfuzzer_defines, cflags) in cross_compile_configs(
-            stage2_install, platform=(not ndk_cxx)):
-        logger().info('Building libfuzzer for %s (ndk_cxx? %s)', arch, ndk_cxx)
+    libfuzzer_path = utils.out_path('lib', 'libfuzzer-' + arch)
+    if ndk_cxx:
+        libfuzzer_path += '-ndk-cxx'
 
-        libfuzzer_path = utils.out_path('lib', 'libfuzzer-' + arch)
-        if ndk_cxx:
-            libfuzzer_path += '-ndk-cxx'
+    libfuzzer_defines['ANDROID'] = '1'
+    libfuzzer_defines['LLVM_CONFIG_PATH'] = llvm_config
 
-        libfuzzer_defines['ANDROID'] = '1'
-        libfuzzer_defines['LLVM_CONFIG_PATH'] = llvm_config
+    cflags.extend('-isystem ' + d for d in libcxx_header_dirs(ndk_cxx))
 
-        cflags.extend('-isystem ' + d for d in libcxx_header_dirs(ndk_cxx))
+    libfuzzer_defines['CMAKE_C_FLAGS'] = ' '.join(cflags)
+    libfuzzer_defines['CMAKE_CXX_FLAGS'] = ' '.join(cflags)
 
-        libfuzzer_defines['CMAKE_C_FLAGS'] = ' '.join(cflags)
-        libfuzzer_defines['CMAKE_CXX_FLAGS'] = ' '.join(cflags)
+    # lib/Fuzzer/CMakeLists.txt does not call cmake_minimum_required() to
+    # set a minimum version.  Explicitly request a policy that'll pass
+    # CMAKE_*_LINKER_FLAGS to the trycompile() step.
+    libfuzzer_defines['CMAKE_POLICY_DEFAULT_CMP0056'] = 'NEW'
 
-        # lib/Fuzzer/CMakeLists.txt does not call cmake_minimum_required() to
-        # set a minimum version.  Explicitly request a policy that'll pass
-        # CMAKE_*_LINKER_FLAGS to the trycompile() step.
-        libfuzzer_defines['CMAKE_POLICY_DEFAULT_CMP0056'] = 'NEW'
+    libfuzzer_cmake_path = utils.llvm_path('projects', 'compiler-rt')
+    libfuzzer_env = dict(ORIG_ENV)
+    invoke_cmake(
+        out_path=libfuzzer_path,
+        defines=libfuzzer_defines,
+        env=libfuzzer_env,
+        cmake_path=libfuzzer_cmake_path,
+        target='fuzzer',
+        install=False,
+        jobs=jobs,
+        clean_cache=True)
+    # We need to install libfuzzer manually.
+    sarch = arch
+    if sarch == 'i386':
+        sarch = 'i686'
+    static_lib_filename = 'libclang_rt.fuzzer-' + sarch + '-android.a'
+    static_lib = os.path.join(libfuzzer_path, 'lib', 'linux', static_lib_filename)
+    triple_arch = arch_from_triple(llvm_triple)
+    if ndk_cxx:
+        lib_subdir = os.path.join('runtimes_ndk_cxx', triple_arch)
+    else:
+        lib_subdir = clang_resource_dir(clang_version.long_version(),
+                                        triple_arch)
+    lib_dir = os.path.join(stage2_install, lib_subdir)
 
-        libfuzzer_cmake_path = utils.llvm_path('projects', 'compiler-rt')
-        libfuzzer_env = dict(ORIG_ENV)
-        rm_cmake_cache(libfuzzer_path)
-        invoke_cmake(
-            out_path=libfuzzer_path,
-            defines=libfuzzer_defines,
-            env=libfuzzer_env,
-            cmake_path=libfuzzer_cmake_path,
-            target='fuzzer',
-            install=False)
-        # We need to install libfuzzer manually.
-        sarch = arch
-        if sarch == 'i386':
-            sarch = 'i686'
-        static_lib_filename = 'libclang_rt.fuzzer-' + sarch + '-android.a'
-        static_lib = os.path.join(libfuzzer_path, 'lib', 'linux', static_lib_filename)
-        triple_arch = arch_from_triple(llvm_triple)
-        if ndk_cxx:
-            lib_subdir = os.path.join('runtimes_ndk_cxx', triple_arch)
-        else:
-            lib_subdir = clang_resource_dir(clang_version.long_version(),
-                                            triple_arch)
-        lib_dir = os.path.join(stage2_install, lib_subdir)
+    check_create_path(lib_dir)
+    shutil.copy2(static_lib, os.path.join(lib_dir, 'libFuzzer.a'))
 
-        check_create_path(lib_dir)
-        shutil.copy2(static_lib, os.path.join(lib_dir, 'libFuzzer.a'))
 
-    # Install libfuzzer headers.
+def install_libfuzzer_headers(stage2_install):
     header_src = utils.llvm_path('projects', 'compiler-rt', 'lib', 'fuzzer')
     header_dst = os.path.join(stage2_install, 'prebuilt_include', 'llvm', 'lib',
                               'Fuzzer')
@@ -488,53 +647,56 @@ def build_libfuzzers(stage2_install, clang_version, ndk_cxx=False):
             shutil.copy2(os.path.join(header_src, f), header_dst)
 
 
-def build_libomp(stage2_install, clang_version, ndk_cxx=False):
-
-    for (arch, llvm_triple, libomp_defines, cflags) in cross_compile_configs(
-            stage2_install, platform=(not ndk_cxx)):
+def build_libomp(stage2_install, clang_version, config, ndk_cxx=False,
+                 jobs=None):
+    """Builds and installs libomp.a for one cross_compile_configs arch.
 
-        logger().info('Building libomp for %s (ndk_cxx? %s)', arch, ndk_cxx)
-        cflags.extend('-isystem ' + d for d in libcxx_header_dirs(ndk_cxx))
+    config must come from cross_compile_configs with platform=(not ndk_cxx).
+    """
+    arch, llvm_triple, libomp_defines, cflags = config
+    logger().info('Building libomp for %s (ndk_cxx? %s)', arch, ndk_cxx)
+    cflags.extend('-isystem ' + d for d in libcxx_header_dirs(ndk_cxx))
 
-        libomp_path = utils.out_path('lib', 'libomp-' + arch)
-        if ndk_cxx:
-            libomp_path += '-ndk-cxx'
+    libomp_path = utils.out_path('lib', 'libomp-' + arch)
+    if ndk_cxx:
+        libomp_path += '-ndk-cxx'
 
-        libomp_defines['ANDROID'] = '1'
-        libomp_defines['CMAKE_BUILD_TYPE'] = 'Release'
-        libomp_defines['CMAKE_C_FLAGS'] = ' '.join(cflags)
-        libomp_defines['CMAKE_CXX_FLAGS'] = ' '.join(cflags)
-        libomp_defines['LIBOMP_ENABLE_SHARED'] = 'FALSE'
+    libomp_defines['ANDROID'] = '1'
+    libomp_defines['CMAKE_BUILD_TYPE'] = 'Release'
+    libomp_defines['CMAKE_C_FLAGS'] = ' '.join(cflags)
+    libomp_defines['CMAKE_CXX_FLAGS'] = ' '.join(cflags)
+    libomp_defines['LIBOMP_ENABLE_SHARED'] = 'FALSE'
 
-        # Minimum version for OpenMP's CMake is too low for the CMP0056 policy
-        # to be ON by default.
-        libomp_defines['CMAKE_POLICY_DEFAULT_CMP0056'] = 'NEW'
+    # Minimum version for OpenMP's CMake is too low for the CMP0056 policy
+    # to be ON by default.
+    libomp_defines['CMAKE_POLICY_DEFAULT_CMP0056'] = 'NEW'
 
-        libomp_cmake_path = utils.llvm_path('projects', 'openmp', 'runtime')
-        libomp_env = dict(ORIG_ENV)
-        rm_cmake_cache(libomp_path)
-        invoke_cmake(
-            out_path=libomp_path,
-            defines=libomp_defines,
-            env=libomp_env,
-            cmake_path=libomp_cmake_path,
-            install=False)
-
-        # We need to install libomp manually.
-        static_lib = os.path.join(libomp_path, 'src', 'libomp.a')
-        triple_arch = arch_from_triple(llvm_triple)
-        if ndk_cxx:
-            lib_subdir = os.path.join('runtimes_ndk_cxx', triple_arch)
-        else:
-            lib_subdir = clang_resource_dir(clang_version.long_version(),
-                                            triple_arch)
-        lib_dir = os.path.join(stage2_install, lib_subdir)
+    libomp_cmake_path = utils.llvm_path('projects', 'openmp', 'runtime')
+    libomp_env = dict(ORIG_ENV)
+    invoke_cmake(
+        out_path=libomp_path,
+        defines=libomp_defines,
+        env=libomp_env,
+        cmake_path=libomp_cmake_path,
+        install=False,
+        jobs=jobs,
+        clean_cache=True)
+
+    # We need to install libomp manually.
+    static_lib = os.path.join(libomp_path, 'src', 'libomp.a')
+    triple_arch = arch_from_triple(llvm_triple)
+    if ndk_cxx:
+        lib_subdir = os.path.join('runtimes_ndk_cxx', triple_arch)
+    else:
+        lib_subdir = clang_resource_dir(clang_version.long_version(),
+                                        triple_arch)
+    lib_dir = os.path.join(stage2_install, lib_subdir)
 
-        check_create_path(lib_dir)
-        shutil.copy2(static_lib, os.path.join(lib_dir, 'libomp.a'))
+    check_create_path(lib_dir)
+    shutil.copy2(static_lib, os.path.join(lib_dir, 'libomp.a'))
 
 
-def build_crts_host_i686(stage2_install, clang_version):
+def build_crts_host_i686(stage2_install, clang_version, jobs=None):
     llvm_config = os.path.join(stage2_install, 'bin', 'llvm-config')
 
     crt_install = os.path.join(stage2_install, 'lib64', 'clang',
@@ -570,20 +732,72 @@ def build_crts_host_i686(stage2_install, clang_version):
     crt_env = dict(ORIG_ENV)
 
     crt_path = utils.out_path('lib', 'clangrt-i386-host')
-    rm_cmake_cache(crt_path)
     invoke_cmake(
         out_path=crt_path,
         defines=crt_defines,
         env=crt_env,
-        cmake_path=crt_cmake_path)
+        cmake_path=crt_cmake_path,
+        jobs=jobs,
+        clean_cache=True)
+
+
+def source_revisions():
+    """Returns the revision and local changes of every source project.
+
+    A project's entry is None if git cannot describe it, so a stage built
+    from it never looks up to date.
+    """
+    if _SOURCE_REVISIONS:
+        return _SOURCE_REVISIONS[0]
+    revisions = {}
+    for project in LLVM_PROJECTS:
+        project_path = utils.android_path('toolchain', project)
+        try:
+            head = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=project_path).strip()
+            diff = subprocess.check_output(
+                ['git', 'diff', 'HEAD', '--', '.'], cwd=project_path)
+        except (OSError, subprocess.CalledProcessError):
+            revisions[project] = None
+            continue
+        revisions[project] = [
+            head.decode('utf-8'), hashlib.sha256(diff).hexdigest()
+        ]
+    _SOURCE_REVISIONS.append(revisions)
+    return revisions
 
 
-def build_llvm(targets,
-               build_dir,
-               install_dir,
-               build_name,
-               extra_defines=None,
-               extra_env=None):
+def stage_manifest(defines, env, **extra):
+    """Returns the inputs of a stage build, as compared across runs."""
+    inputs = {
+        'sources': source_revisions(),
+        'prebuilt': clang_prebuilt_version(),
+        'defines': defines,
+        'env': dict((key, value) for key, value in env.items()
+                    if key not in VOLATILE_ENV),
+    }
+    inputs.update(extra)
+    return json.dumps(inputs, sort_keys=True, indent=2)
+
+
+def stage_manifest_path(install_dir):
+    return install_dir + '.manifest'
+
+
+def stage_is_current(install_dir, manifest):
+    if None in source_revisions().values():
+        return False
+    return (os.path.isdir(install_dir) and
+            read_file(stage_manifest_path(install_dir)) == manifest)
+
+
+def write_stage_manifest(install_dir, manifest):
+    with open(stage_manifest_path(install_dir), 'w') as manifest_file:
+        manifest_file.write(manifest)
+
+
+def llvm_cmake_defines(targets, install_dir, build_name, extra_defines=None):
+    """Returns the cmake defines build_llvm configures with."""
     cmake_defines = base_cmake_defines()
     cmake_defines['CMAKE_INSTALL_PREFIX'] = install_dir
     cmake_defines['LLVM_TARGETS_TO_BUILD'] = targets
@@ -595,15 +809,28 @@ def build_llvm(targets,
 
     if extra_defines is not None:
         cmake_defines.update(extra_defines)
+    return cmake_defines
+
 
+def llvm_env(extra_env=None):
+    """Returns the environment build_llvm configures and builds with."""
     env = dict(ORIG_ENV)
     if extra_env is not None:
         env.update(extra_env)
+    return env
 
+
+def build_llvm(targets,
+               build_dir,
+               install_dir,
+               build_name,
+               extra_defines=None,
+               extra_env=None):
     invoke_cmake(
         out_path=build_dir,
-        defines=cmake_defines,
-        env=env,
+        defines=llvm_cmake_defines(targets, install_dir, build_name,
+                                   extra_defines),
+        env=llvm_env(extra_env),
         cmake_path=utils.llvm_path())
 
 
@@ -674,19 +901,18 @@ def build_llvm_for_windows(targets,
     windows_extra_defines['CMAKE_SHARED_LINKER_FLAGS'] = ' '.join(ldflags)
     windows_extra_defines['CMAKE_MODULE_LINKER_FLAGS'] = ' '.join(ldflags)
 
-    build_llvm(
-        targets=targets,
-        build_dir=build_dir,
-        install_dir=install_dir,
-        build_name=build_name,
-        extra_defines=windows_extra_defines)
+    with build_trace.span('windows ' + ('i386' if is_32_bit else 'x86'),
+                          'stage'):
+        build_llvm(
+            targets=targets,
+            build_dir=build_dir,
+            install_dir=install_dir,
+            build_name=build_name,
+            extra_defines=windows_extra_defines)
 
 
-def build_stage1(stage1_install, build_name, build_llvm_tools=False):
-    # Build/install the stage 1 toolchain
-    stage1_path = utils.out_path('stage1')
-    stage1_targets = 'X86'
-
+def stage1_defines(build_llvm_tools=False):
+    """Returns the defines build_stage1 passes to build_llvm."""
     stage1_extra_defines = dict()
     stage1_extra_defines['LLVM_BUILD_RUNTIME'] = 'ON'
     stage1_extra_defines['CLANG_ENABLE_ARCMT'] = 'OFF'
@@ -731,30 +957,48 @@ def build_stage1(stage1_install, build_name, build_llvm_tools=False):
     # Don't build libfuzzer, since it's broken on Darwin and we don't need it
     # anyway.
     stage1_extra_defines['COMPILER_RT_BUILD_LIBFUZZER'] = 'OFF'
+    return stage1_extra_defines
 
-    build_llvm(
-        targets=stage1_targets,
-        build_dir=stage1_path,
-        install_dir=stage1_install,
-        build_name=build_name,
-        extra_defines=stage1_extra_defines)
 
+def build_stage1(stage1_install, build_name, build_llvm_tools=False,
+                 incremental=False):
+    """Builds and installs the stage 1 toolchain.
 
-def build_stage2(stage1_install,
-                 stage2_install,
-                 stage2_targets,
-                 build_name,
-                 use_lld=False,
-                 enable_assertions=False,
-                 debug_build=False,
-                 build_instrumented=False,
-                 profdata_file=None):
+    With incremental, an existing stage1_install built from the same inputs
+    is reused.
+    """
+    stage1_path = utils.out_path('stage1')
+    stage1_targets = 'X86'
+    stage1_extra_defines = stage1_defines(build_llvm_tools)
+
+    manifest = stage_manifest(
+        llvm_cmake_defines(stage1_targets, stage1_install, build_name,
+                           stage1_extra_defines), llvm_env())
+    if incremental and stage_is_current(stage1_install, manifest):
+        logger().info('Stage1 inputs unchanged, reusing %s', stage1_install)
+        return
+    utils.remove(stage_manifest_path(stage1_install))
+
+    with build_trace.span('stage1', 'stage'):
+        build_llvm(
+            targets=stage1_targets,
+            build_dir=stage1_path,
+            install_dir=stage1_install,
+            build_name=build_name,
+            extra_defines=stage1_extra_defines)
+    write_stage_manifest(stage1_install, manifest)
+
+
+def stage2_defines(stage1_install,
+                   use_lld=False,
+                   enable_assertions=False,
+                   debug_build=False,
+                   build_instrumented=False,
+                   profdata_file=None):
+    """Returns the defines build_stage2 passes to build_llvm."""
     # TODO(srhines): Build LTO plugin (Chromium folks say ~10% perf speedup)
-
-    # Build/install the stage2 toolchain
     stage2_cc = os.path.join(stage1_install, 'bin', 'clang')
     stage2_cxx = os.path.join(stage1_install, 'bin', 'clang++')
-    stage2_path = utils.out_path('stage2')
 
     stage2_extra_defines = dict()
     stage2_extra_defines['CMAKE_C_COMPILER'] = stage2_cc
@@ -812,41 +1056,159 @@ def build_stage2(stage1_install,
     # stdatomic.h.
     if utils.host_is_darwin():
         stage2_extra_defines['LLVM_BUILD_EXTERNAL_COMPILER_RT'] = 'ON'
+    return stage2_extra_defines
 
+
+def stage2_env(stage1_install):
+    """Returns the extra environment build_stage2 passes to build_llvm."""
     # Point CMake to the libc++ from stage1.  It is possible that once built,
     # the newly-built libc++ may override this because of the rpath pointing to
     # $ORIGIN/../lib64.  That'd be fine because both libraries are built from
     # the same sources.
     stage2_extra_env = dict()
     stage2_extra_env['LD_LIBRARY_PATH'] = os.path.join(stage1_install, 'lib64')
+    return stage2_extra_env
 
-    build_llvm(
-        targets=stage2_targets,
-        build_dir=stage2_path,
-        install_dir=stage2_install,
-        build_name=build_name,
-        extra_defines=stage2_extra_defines,
-        extra_env=stage2_extra_env)
 
+def build_stage2(stage1_install,
+                 stage2_install,
+                 stage2_targets,
+                 build_name,
+                 use_lld=False,
+                 enable_assertions=False,
+                 debug_build=False,
+                 build_instrumented=False,
+                 profdata_file=None,
+                 incremental=False):
+    """Builds and installs the stage2 toolchain with the stage1 one.
 
-def build_runtimes(stage2_install):
-    version = extract_clang_version(stage2_install)
-    build_crts(stage2_install, version)
-    build_crts_host_i686(stage2_install, version)
-    build_libfuzzers(stage2_install, version)
-    build_libfuzzers(stage2_install, version, ndk_cxx=True)
-    build_libomp(stage2_install, version)
-    build_libomp(stage2_install, version, ndk_cxx=True)
+    With incremental, an existing stage2_install built from the same inputs,
+    including the same stage1 inputs, is reused. Otherwise it is replaced.
+    """
+    stage2_path = utils.out_path('stage2')
+    stage2_extra_defines = stage2_defines(
+        stage1_install, use_lld, enable_assertions, debug_build,
+        build_instrumented, profdata_file)
+    stage2_extra_env = stage2_env(stage1_install)
+
+    manifest = stage_manifest(
+        llvm_cmake_defines(stage2_targets, stage2_install, build_name,
+                           stage2_extra_defines),
+        llvm_env(stage2_extra_env),
+        stage1=read_file(stage_manifest_path(stage1_install)),
+        profdata=file_identity(profdata_file) if profdata_file else None)
+    if incremental:
+        if stage_is_current(stage2_install, manifest):
+            logger().info('Stage2 inputs unchanged, reusing %s',
+                          stage2_install)
+            return
+        utils.remove(stage2_install)
+    utils.remove(stage_manifest_path(stage2_install))
+
+    with build_trace.span('stage2', 'stage'):
+        build_llvm(
+            targets=stage2_targets,
+            build_dir=stage2_path,
+            install_dir=stage2_install,
+            build_name=build_name,
+            extra_defines=stage2_extra_defines,
+            extra_env=stage2_extra_env)
+    write_stage_manifest(stage2_install, manifest)
+
+
+def build_runtimes(stage2_install, max_workers=RUNTIME_WORKERS):
+    with build_trace.span('runtimes', 'stage'):
+        _build_runtimes(stage2_install, max_workers)
+
+
+def runtime_tasks(stage2_install, version, map_pool, jobs=None):
+    """Returns the scheduler tasks building the runtimes.
+
+    The compiler-rt, libfuzzer and libomp builds of every arch are
+    independent of each other. Only the asan map files need the asan
+    runtimes to be installed; they are generated on map_pool, which must be
+    created before the scheduler starts its threads.
+    """
+    tasks = []
+    crts = []
+    for config in cross_compile_configs(stage2_install):
+        name = 'compiler-rt ' + config[0]
+        crts.append(name)
+        tasks.append(scheduler.Task(
+            name, functools.partial(build_crt, stage2_install, version, config,
+                                    jobs=jobs)))
+    tasks.append(scheduler.Task(
+        'compiler-rt i386-host',
+        functools.partial(build_crts_host_i686, stage2_install, version,
+                          jobs=jobs)))
+    for ndk_cxx in (False, True):
+        suffix = ' ndk-cxx' if ndk_cxx else ''
+        for config in cross_compile_configs(stage2_install,
+                                            platform=(not ndk_cxx)):
+            tasks.append(scheduler.Task(
+                'libfuzzer ' + config[0] + suffix,
+                functools.partial(build_libfuzzer, stage2_install, version,
+                                  config, ndk_cxx=ndk_cxx, jobs=jobs)))
+    for ndk_cxx in (False, True):
+        suffix = ' ndk-cxx' if ndk_cxx else ''
+        for config in cross_compile_configs(stage2_install,
+                                            platform=(not ndk_cxx)):
+            tasks.append(scheduler.Task(
+                'libomp ' + config[0] + suffix,
+                functools.partial(build_libomp, stage2_install, version,
+                                  config, ndk_cxx=ndk_cxx, jobs=jobs)))
+    tasks.append(scheduler.Task(
+        'libfuzzer headers',
+        functools.partial(install_libfuzzer_headers, stage2_install)))
     # Bug: http://b/64037266. `strtod_l` is missing in NDK r15. This will break
     # libcxx build.
     # build_libcxx(stage2_install, version)
-    build_asan_test(stage2_install)
-    build_asan_map_files(stage2_install, version)
+    tasks.append(scheduler.Task(
+        'asan test', functools.partial(build_asan_test, stage2_install)))
+    tasks.append(scheduler.Task(
+        'asan map files',
+        functools.partial(build_asan_map_files, stage2_install, version,
+                          map_pool),
+        deps=crts))
+    return tasks
 
 
-def install_wrappers(llvm_install_path):
+def _build_runtimes(stage2_install, max_workers):
+    version = extract_clang_version(stage2_install)
+    jobs = max(1, _CPU_BUDGET.total // max_workers)
+    # Fork the map file workers while this is the only thread.
+    map_pool = multiprocessing.Pool(len(ASAN_MAP_ARCHES))
+    try:
+        tasks = runtime_tasks(stage2_install, version, map_pool, jobs)
+        serial_time, wall_time = scheduler.run_tasks(tasks, max_workers)
+    finally:
+        map_pool.close()
+        map_pool.join()
+    logger().info('Built %d runtimes in %.1fs instead of %.1fs serially '
+                  '(%.1fx)', len(tasks), wall_time, serial_time,
+                  serial_time / max(wall_time, 1e-6))
+
+
+# Launcher for the compiler wrapper that skips site initialization and
+# environment-dependent setup and imports the precompiled wrapper module.
+FAST_LAUNCHER = """#!{python} -SE
+import sys
+import compiler_wrapper
+compiler_wrapper.main(sys.argv, __file__)
+"""
+
+
+def install_wrappers(llvm_install_path, fast_launcher=False):
+    """Installs compiler wrappers in front of clang, clang++ and clang-tidy.
+
+    With fast_launcher, the wrappers are small launchers for the interpreter
+    running this script instead of copies of compiler_wrapper.py. They cut
+    Python startup time per compile, but hard-code the interpreter path, so
+    they are only meant for local installs and not for packaged toolchains.
+    """
     wrapper_path = utils.llvm_path('android', 'compiler_wrapper.py')
     bisect_path = utils.llvm_path('android', 'bisect_driver.py')
+    cache_path = utils.llvm_path('android', 'compile_cache.py')
     bin_path = os.path.join(llvm_install_path, 'bin')
     clang_path = os.path.join(bin_path, 'clang')
     clangxx_path = os.path.join(bin_path, 'clang++')
@@ -866,10 +1228,21 @@ def install_wrappers(llvm_install_path):
     utils.remove(clangxx_path + '.real')
     os.symlink('clang.real', clangxx_path + '.real')
 
-    shutil.copy2(wrapper_path, clang_path)
-    shutil.copy2(wrapper_path, clangxx_path)
-    shutil.copy2(wrapper_path, clang_tidy_path)
+    if fast_launcher:
+        wrapper_module = os.path.join(bin_path, 'compiler_wrapper.py')
+        install_file(wrapper_path, wrapper_module)
+        py_compile.compile(wrapper_module, doraise=True)
+        launcher = FAST_LAUNCHER.format(python=sys.executable)
+        for path in (clang_path, clangxx_path, clang_tidy_path):
+            with open(path, 'w') as launcher_file:
+                launcher_file.write(launcher)
+            os.chmod(path, 0o755)
+    else:
+        shutil.copy2(wrapper_path, clang_path)
+        shutil.copy2(wrapper_path, clangxx_path)
+        shutil.copy2(wrapper_path, clang_tidy_path)
     install_file(bisect_path, bin_path)
+    install_file(cache_path, bin_path)
 
 
 # Normalize host libraries (libLLVM, libclang, libc++, libc++abi) so that there
@@ -922,17 +1295,6 @@ def normalize_llvm_host_libs(install_dir, host, version):
 
 
 def install_license_files(install_dir):
-    projects = (
-        'llvm',
-        'llvm/projects/compiler-rt',
-        'llvm/projects/libcxx',
-        'llvm/projects/libcxxabi',
-        'llvm/projects/openmp',
-        'llvm/tools/clang',
-        'llvm/tools/clang/tools/extra',
-        'llvm/tools/lld',
-    )
-
     # Get generic MODULE_LICENSE_* files from our android subdirectory.
     toolchain_path = utils.android_path('toolchain')
     llvm_android_path = os.path.join(toolchain_path, 'llvm', 'android')
@@ -943,13 +1305,15 @@ def install_license_files(install_dir):
     # Fetch all the LICENSE.* files under our projects and append them into a
     # single NOTICE file for the resulting prebuilts.
     notices = []
-    for project in projects:
+    for project in LLVM_PROJECTS:
         project_path = os.path.join(toolchain_path, project)
         license_pattern = os.path.join(project_path, 'LICENSE.*')
         for license_file in glob.glob(license_pattern):
             with open(license_file) as notice_file:
                 notices.append(notice_file.read())
-    with open(os.path.join(install_dir, 'NOTICE'), 'w') as notice_file:
+    notice_path = os.path.join(install_dir, 'NOTICE')
+    utils.remove(notice_path)
+    with open(notice_path, 'w') as notice_file:
         notice_file.write('\n'.join(notices))
 
 
@@ -968,16 +1332,75 @@ def install_winpthreads(is_windows32, install_dir):
     install_file(lib_path, lib_install)
 
 
-def remove_static_libraries(static_lib_dir):
-    if os.path.isdir(static_lib_dir):
-        lib_files = os.listdir(static_lib_dir)
-        for lib_file in lib_files:
-            if lib_file.endswith('.a'):
-                static_library = os.path.join(static_lib_dir, lib_file)
-                remove(static_library)
-
-
-def package_toolchain(build_dir, build_name, host, dist_dir, strip=True):
+def stage_tree(src_dir, dst_dir, shipped, modified):
+    """Recreates the shipped files of src_dir in dst_dir.
+
+    shipped and modified are called with the path of each file in src_dir.
+    Files that are modified in place later are copied. The others are
+    hardlinked to src_dir, so that staging does not copy their contents, and
+    are only copied if src_dir and dst_dir are on different filesystems.
+    Symlinks are recreated as they are.
+
+    Returns:
+        List of the staged paths that were copied because of modified.
+    """
+    copied = []
+    for root, dirs, files in os.walk(src_dir):
+        dst_root = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        check_create_path(dst_root)
+        # os.walk does not descend into symlinks to directories, but lists
+        # them with the directories.
+        for name in dirs + files:
+            src = os.path.join(root, name)
+            if os.path.islink(src) and shipped(src):
+                os.symlink(os.readlink(src), os.path.join(dst_root, name))
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(dst_root, name)
+            if os.path.islink(src) or not shipped(src):
+                continue
+            if modified(src):
+                shutil.copy2(src, dst)
+                copied.append(dst)
+                continue
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+    return copied
+
+
+def strip_binaries(binaries, host, jobs=None):
+    """Strips binaries on up to jobs slots of the CPU budget.
+
+    ELF files without a symbol table are already stripped and are skipped.
+    """
+
+    def strip_binary(binary):
+        if elf.is_stripped(binary):
+            logger().info('Already stripped: %s', binary)
+            return
+        with build_trace.span(
+                'strip ' + os.path.basename(binary), 'strip', host=host):
+            check_call(['strip', binary])
+
+    with _CPU_BUDGET.reserve(jobs) as workers:
+        pool = multiprocessing.pool.ThreadPool(workers)
+        try:
+            pool.map(strip_binary, binaries)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def package_toolchain(build_dir, build_name, host, dist_dir, strip=True,
+                      package_format=archive.DEFAULT_FORMAT, package_level=None,
+                      jobs=None):
+    """Trims a copy of build_dir and packages it for host.
+
+    The package is compressed with up to jobs slots of the CPU budget, all
+    of them if jobs is None.
+    """
     is_windows32 = host == 'windows-i386'
     is_windows64 = host == 'windows-x86'
     is_windows = is_windows32 or is_windows64
@@ -992,9 +1415,6 @@ def package_toolchain(build_dir, build_name, host, dist_dir, strip=True):
     if os.path.exists(install_host_dir):
         shutil.rmtree(install_host_dir)
 
-    # First copy over the entire set of output objects.
-    shutil.copytree(build_dir, install_dir, symlinks=True)
-
     ext = '.exe' if is_windows else ''
     shlib_ext = '.dll' if is_windows else '.so' if is_linux else '.dylib'
 
@@ -1034,23 +1454,39 @@ def package_toolchain(build_dir, build_name, host, dist_dir, strip=True):
         'scan-view',
     ]
 
-    bin_dir = os.path.join(install_dir, 'bin')
-    bin_files = os.listdir(bin_dir)
-    for bin_filename in bin_files:
-        binary = os.path.join(bin_dir, bin_filename)
-        if os.path.isfile(binary):
-            if bin_filename not in necessary_bin_files:
-                remove(binary)
-            elif strip:
-                if bin_filename not in script_bins:
-                    check_call(['strip', binary])
-
-    # Next, we remove unnecessary static libraries.
     if is_windows32:
         lib_dir = 'lib'
     else:
         lib_dir = 'lib64'
-    remove_static_libraries(os.path.join(install_dir, lib_dir))
+    build_bin_dir = os.path.join(build_dir, 'bin')
+    build_lib_dir = os.path.join(build_dir, lib_dir)
+
+    def is_shipped(path):
+        dirname, filename = os.path.split(path)
+        # Skip unnecessary binaries and static libraries.
+        if dirname == build_bin_dir and os.path.isfile(path):
+            return filename in necessary_bin_files
+        if dirname == build_lib_dir:
+            return not filename.endswith('.a')
+        return True
+
+    def is_stripped_later(path):
+        if not strip:
+            return False
+        dirname, filename = os.path.split(path)
+        if dirname == build_bin_dir:
+            return filename not in script_bins
+        # The host shared libraries are stripped along with the binaries.
+        return is_linux and dirname == build_lib_dir and '.so' in filename
+
+    # Stage the shipped files only. strip rewrites files in place, so those
+    # are copied instead of linked to build_dir.
+    with build_trace.span('stage ' + host, 'package'):
+        binaries_to_strip = stage_tree(build_dir, install_dir, is_shipped,
+                                       is_stripped_later)
+
+    if binaries_to_strip:
+        strip_binaries(binaries_to_strip, host, jobs)
 
     # For Windows, add other relevant libraries.
     if is_windows:
@@ -1072,16 +1508,19 @@ def package_toolchain(build_dir, build_name, host, dist_dir, strip=True):
 
     # Add an AndroidVersion.txt file.
     version_file_path = os.path.join(install_dir, 'AndroidVersion.txt')
+    utils.remove(version_file_path)
     with open(version_file_path, 'w') as version_file:
         version_file.write('{}\n'.format(version.long_version()))
         version_file.write('based on {}\n'.format(android_version.svn_revision))
 
     # Package up the resulting trimmed install/ directory.
     tarball_name = package_name + '-' + host
-    package_path = os.path.join(dist_dir, tarball_name) + '.tar.bz2'
-    logger().info('Packaging %s', package_path)
-    args = ['tar', '-cjC', install_host_dir, '-f', package_path, package_name]
-    check_call(args)
+    package_base = os.path.join(dist_dir, tarball_name)
+    logger().info('Packaging %s as %s', package_base, package_format)
+    with _CPU_BUDGET.reserve(jobs) as threads, build_trace.span(
+            'tar ' + host, 'package', format=package_format, threads=threads):
+        archive.create(install_host_dir, package_name, package_base,
+                       package_format, package_level, threads)
 
 
 def parse_args():
@@ -1155,11 +1594,66 @@ def parse_args():
         default=False,
         help='Fail if expected PGO profile doesn\'t exist')
 
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help='Number of jobs shared by all the cmake and ninja invocations '
+        '(defaults to the number of CPUs).')
+
+    parser.add_argument(
+        '-l',
+        '--load-average',
+        type=float,
+        help='Do not start new ninja jobs while the load average is above '
+        'this.')
+
+    parser.add_argument(
+        '--package-format',
+        choices=archive.FORMATS,
+        default=archive.DEFAULT_FORMAT,
+        help='Compression of the packages (defaults to %s)' %
+        archive.DEFAULT_FORMAT)
+
+    parser.add_argument(
+        '--package-level',
+        type=int,
+        help='Compression level of the packages (defaults to the format\'s '
+        'default in archive.DEFAULT_LEVELS)')
+
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help='Reuse stage1 and stage2 installs built from the same inputs')
+
+    parser.add_argument(
+        '--reconfigure',
+        action='store_true',
+        default=False,
+        help='Run cmake configure even if its inputs are unchanged')
+
+    parser.add_argument(
+        '--trace-file',
+        help='Write a Chrome trace of the build phases to this file.')
+
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
+    if args.trace_file:
+        build_trace.enable()
+    try:
+        return build_and_package(args)
+    finally:
+        build_trace.write(args.trace_file)
+
+
+def build_and_package(args):
+    set_cpu_budget(args.jobs, args.load_average)
+    set_reconfigure(args.reconfigure)
     do_build = not args.skip_build
     do_package = not args.skip_package
     do_strip = not args.no_strip
@@ -1179,15 +1673,19 @@ def main():
     # TODO(pirama): Once we have a set of prebuilts with lld, pass use_lld for
     # stage1 as well.
     if do_build:
-        for install_dir in (stage2_install, windows32_install,
-                            windows64_install):
+        # build_stage2 replaces stage2_install itself if it is out of date.
+        install_dirs = [windows32_install, windows64_install]
+        if not args.incremental:
+            install_dirs.append(stage2_install)
+        for install_dir in install_dirs:
             if os.path.exists(install_dir):
                 utils.rm_tree(install_dir)
 
         instrumented = utils.host_is_linux() and args.build_instrumented
 
         build_stage1(stage1_install, args.build_name,
-                     build_llvm_tools=instrumented)
+                     build_llvm_tools=instrumented,
+                     incremental=args.incremental)
 
         long_version = extract_clang_long_version(stage1_install)
         profdata = pgo_profdata_file(long_version)
@@ -1199,7 +1697,8 @@ def main():
 
         build_stage2(stage1_install, stage2_install, STAGE2_TARGETS,
                      args.build_name, args.use_lld, args.enable_assertions,
-                     args.debug, instrumented, profdata)
+                     args.debug, instrumented, profdata,
+                     incremental=args.incremental)
 
     if do_build and utils.host_is_linux():
         build_runtimes(stage2_install)
@@ -1231,26 +1730,30 @@ def main():
 
     if do_package:
         dist_dir = ORIG_ENV.get('DIST_DIR', utils.out_path())
-        package_toolchain(
-            stage2_install,
-            args.build_name,
-            utils.build_os_type(),
-            dist_dir,
-            strip=do_strip_host_package)
-
+        packages = [(stage2_install, utils.build_os_type(),
+                     do_strip_host_package)]
         if need_windows:
-            package_toolchain(
-                windows32_install,
-                args.build_name,
-                'windows-i386',
-                dist_dir,
-                strip=do_strip)
-            package_toolchain(
-                windows64_install,
-                args.build_name,
-                'windows-x86',
-                dist_dir,
-                strip=do_strip)
+            packages.append((windows32_install, 'windows-i386', do_strip))
+            packages.append((windows64_install, 'windows-x86', do_strip))
+
+        # The hosts are packaged concurrently, each compressing with its
+        # share of the CPU budget.
+        jobs = max(1, _CPU_BUDGET.total // len(packages))
+        tasks = [
+            scheduler.Task(
+                'package ' + host,
+                functools.partial(
+                    package_toolchain,
+                    install_dir,
+                    args.build_name,
+                    host,
+                    dist_dir,
+                    strip=strip,
+                    package_format=args.package_format,
+                    package_level=args.package_level,
+                    jobs=jobs)) for install_dir, host, strip in packages
+        ]
+        scheduler.run_tasks(tasks, len(tasks))
 
     return 0
 
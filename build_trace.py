@@ -0,0 +1,113 @@
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Records spans of the toolchain build in the Chrome trace-event format.
+
+The resulting JSON file can be opened in chrome://tracing or Perfetto. Spans
+are only recorded after enable() is called, so instrumented code costs next
+to nothing otherwise.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Tracer(object):
+    """Collects complete ('X') trace events from any thread."""
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._tids = {}
+
+    def _tid(self):
+        """Returns a small, stable id for the current thread."""
+        thread = threading.current_thread()
+        with self._lock:
+            if thread.ident not in self._tids:
+                tid = len(self._tids) + 1
+                self._tids[thread.ident] = tid
+                self.events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': self.pid,
+                    'tid': tid,
+                    'args': {'name': thread.name},
+                })
+            return self._tids[thread.ident]
+
+    def add_span(self, name, category, start, end, args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': self.pid,
+            'tid': self._tid(),
+            'args': args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category, args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start, time.time(), args)
+
+    def write(self, path):
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event.get('ts', 0))
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                      trace_file)
+
+
+_tracer = None
+
+
+def enable():
+    """Starts recording spans."""
+    global _tracer
+    _tracer = Tracer()
+
+
+@contextlib.contextmanager
+def _no_span():
+    yield
+
+
+def span(name, category='build', **args):
+    """Returns a context manager recording a span around its body.
+
+    Keyword arguments are shown with the span in the trace viewer.
+    """
+    if _tracer is None:
+        return _no_span()
+    return _tracer.span(name, category, args)
+
+
+def write(path):
+    """Writes the spans recorded so far to path, if tracing is enabled."""
+    if _tracer is not None:
+        _tracer.write(path)
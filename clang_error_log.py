@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Merge and query the clang-error.log written by compiler_wrapper.py."""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import glob
+import json
+import os
+import re
+import sys
+import tempfile
+
+
+def shard_paths(log_path):
+    """Returns the per-process shards (log_path.<pid>) of a log."""
+    return sorted(path for path in glob.glob(log_path + '.*')
+                  if path[len(log_path) + 1:].isdigit())
+
+
+def read_records(path):
+    records = []
+    with open(path) as log_file:
+        for line in log_file:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def load_records(log_path):
+    """Returns the records of a log and its shards, oldest first."""
+    records = []
+    for path in [log_path] + shard_paths(log_path):
+        if os.path.exists(path):
+            records.extend(read_records(path))
+    records.sort(key=lambda record: (record['time'],
+                                     json.dumps(record, sort_keys=True)))
+    return records
+
+
+def merge(log_path):
+    """Folds the shards of a log into the log itself."""
+    shards = shard_paths(log_path)
+    records = load_records(log_path)
+    log_dir = os.path.dirname(os.path.abspath(log_path))
+    fd, tmp_path = tempfile.mkstemp(dir=log_dir)
+    with os.fdopen(fd, 'w') as log_file:
+        for record in records:
+            log_file.write(json.dumps(record, sort_keys=True) + '\n')
+    os.rename(tmp_path, log_path)
+    for shard in shards:
+        os.remove(shard)
+    print('Merged %d shards, %d records' % (len(shards), len(records)))
+
+
+def first_error(record):
+    """Returns the first error diagnostic of a record, without location."""
+    for line in record['stderr'].splitlines():
+        match = re.search(r'(?:fatal )?error: (.*)', line)
+        if match:
+            return match.group(1)
+    return '(no error diagnostic)'
+
+
+def summary(log_path, top):
+    records = load_records(log_path)
+    print('%d failed compiles' % len(records))
+
+    exit_codes = collections.Counter(record['exit_code'] for record in records)
+    print('\nExit codes:')
+    for exit_code, count in exit_codes.most_common():
+        print('  %6d  %s' % (count, exit_code))
+
+    errors = collections.Counter(first_error(record) for record in records)
+    print('\nMost common errors:')
+    for error, count in errors.most_common(top):
+        print('  %6d  %s' % (count, error))
+
+    timed = [record for record in records if record['duration'] is not None]
+    timed.sort(key=lambda record: record['duration'], reverse=True)
+    print('\nSlowest failed compiles:')
+    for record in timed[:top]:
+        print('  %7.2fs  %s' % (record['duration'],
+                                ' '.join(record['command'])))
+
+
+def show(log_path):
+    """Prints the records in the format of the old text log."""
+    for record in load_records(log_path):
+        print('==================COMMAND:====================')
+        print(' '.join(record['command']) + '\n')
+        sys.stdout.write(record['stderr'])
+        if record['stderr_truncated']:
+            print('[diagnostics truncated]')
+        print('==============================================\n')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('log', help='Path of clang-error.log.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser(
+        'merge', help='Merge per-process shards into the log.')
+    summary_parser = subparsers.add_parser(
+        'summary', help='Summarize failures by exit code, error and time.')
+    summary_parser.add_argument(
+        '--top', type=int, default=10, help='Number of entries to list.')
+    subparsers.add_parser('show', help='Print records as plain text.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'merge':
+        merge(args.log)
+    elif args.command == 'summary':
+        summary(args.log, args.top)
+    elif args.command == 'show':
+        show(args.log)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,490 @@
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Persistent caches used by compiler_wrapper.py.
+
+CompileCache is a local, content-addressed cache of compile outputs, in the
+spirit of ccache. FailureMemo remembers the compiles that the new compiler
+fails, so that an incremental rebuild sends them straight to the prebuilt
+compiler instead of paying for a failing compile first.
+
+Cache entries live in a subdirectory named after the identity of the real
+compiler binary, so replacing clang.real invalidates all of them. The entries
+of a replaced compiler are never used again and are the first to be evicted.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+STATS_FILE = '_STATS'
+CLEANUP_LOCK = '_CLEANUP.lock'
+# Fraction of the stores that check the size of the compile cache.
+CLEANUP_PROBABILITY = 0.01
+# A cleanup evicts entries until the cache is below this fraction of its cap.
+CLEANUP_TARGET = 0.9
+DEFAULT_MAX_SIZE = '20G'
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+# Arguments whose side effects the compile cache does not reproduce.
+# Coverage compiles write .gcno notes next to the object.
+UNCACHEABLE_ARGS = ('-MJ', '-save-temps', '-ftime-trace',
+                    '--serialize-diagnostics', '--coverage', '-ftest-coverage')
+# Arguments naming inputs that the preprocessor does not read. Their contents
+# are part of the cache key.
+INPUT_FILE_ARGS = ('-fprofile-use=', '-fprofile-instr-use=',
+                   '-fprofile-sample-use=', '-fsanitize-blacklist=',
+                   '-fsanitize-ignorelist=')
+# Arguments dropped, together with their value, when preprocessing.
+OUTPUT_ARGS_WITH_VALUE = ('-o', '-MF', '-MT', '-MQ', '-MJ')
+OUTPUT_ARGS = ('-c', '-MD', '-MMD')
+# At most this much of the diagnostics is kept for a memoized failure.
+STDERR_MEMO_LIMIT = 1 << 20
+
+
+def compiler_identity(compiler):
+    """Returns a short digest identifying the compiler binary."""
+    path = os.path.realpath(compiler)
+    st = os.stat(path)
+    identity = '%s:%d:%r:%d' % (path, st.st_size, st.st_mtime, st.st_ino)
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+
+def parse_size(size):
+    """Returns the number of bytes in a size like 512M or 20G."""
+    size = size.strip().upper()
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def is_cacheable(args):
+    """Returns whether args is a plain single-source compile to an object."""
+    return ('-c' in args and '-o' in args and '-E' not in args and
+            not any(arg.startswith('@') for arg in args) and
+            not any(arg.startswith(UNCACHEABLE_ARGS) for arg in args))
+
+
+def arg_value(args, name):
+    """Returns the value of the last occurrence of name in args, or None."""
+    value = None
+    for i, arg in enumerate(args[:-1]):
+        if arg == name:
+            value = args[i + 1]
+    return value
+
+
+def output_paths(args):
+    """Returns {kind: path} for the files written by a compile.
+
+    kind is 'o' for the object, 'd' for the dependency file and 'dwo' for
+    split debug info.
+    """
+    obj_path = arg_value(args, '-o')
+    outputs = {'o': obj_path}
+    dep_path = arg_value(args, '-MF')
+    for arg in args:
+        if arg.startswith(('-Wp,-MD,', '-Wp,-MMD,')):
+            dep_path = arg.split(',', 2)[2]
+    if not dep_path and ('-MD' in args or '-MMD' in args):
+        dep_path = os.path.splitext(obj_path)[0] + '.d'
+    if dep_path:
+        outputs['d'] = dep_path
+    if '-gsplit-dwarf' in args:
+        outputs['dwo'] = os.path.splitext(obj_path)[0] + '.dwo'
+    return outputs
+
+
+def preprocess_args(execargs):
+    """Returns the command preprocessing the input of a compile to stdout."""
+    args = [execargs[0]]
+    skip = False
+    for arg in execargs[1:]:
+        if skip:
+            skip = False
+        elif arg in OUTPUT_ARGS_WITH_VALUE:
+            skip = True
+        elif arg in OUTPUT_ARGS or arg.startswith(('-Wp,-MD,', '-Wp,-MMD,')):
+            pass
+        else:
+            args.append(arg)
+    return args + ['-E', '-o', '-']
+
+
+_digests = {}
+
+
+def preprocessed_digest(execargs):
+    """Returns the digest of the preprocessed input of a compile.
+
+    Returns None if the input cannot be preprocessed. The digest is computed
+    once per process, both caches share it.
+    """
+    key = tuple(execargs)
+    if key not in _digests:
+        _digests[key] = _preprocessed_digest(execargs)
+    return _digests[key]
+
+
+def _preprocessed_digest(execargs):
+    with open(os.devnull, 'wb') as devnull:
+        p = subprocess.Popen(preprocess_args(execargs), stdout=subprocess.PIPE,
+                             stderr=devnull)
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: p.stdout.read(1 << 16), b''):
+            digest.update(chunk)
+        p.stdout.close()
+        if p.wait() != 0:
+            return None
+    return digest.hexdigest()
+
+
+def write_atomically(path, data):
+    """Replaces the file at path with data, creating parent directories."""
+    entry_dir = os.path.dirname(path)
+    if not os.path.isdir(entry_dir):
+        try:
+            os.makedirs(entry_dir)
+        except OSError:
+            if not os.path.isdir(entry_dir):
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=entry_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def record_event(cache_dir, event, seconds=0.0):
+    """Appends an event to the statistics of a cache directory."""
+    data = ('%s %.6f\n' % (event, seconds)).encode('utf-8')
+    fd = os.open(
+        os.path.join(cache_dir, STATS_FILE),
+        os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def read_stats(cache_dir):
+    """Returns {event: (count, seconds)} for a cache directory."""
+    stats = {}
+    try:
+        with open(os.path.join(cache_dir, STATS_FILE)) as stats_file:
+            for line in stats_file:
+                event, seconds = line.split()
+                count, total = stats.get(event, (0, 0.0))
+                stats[event] = (count + 1, total + float(seconds))
+    except IOError:
+        pass
+    return stats
+
+
+def reset_stats(cache_dir):
+    try:
+        os.remove(os.path.join(cache_dir, STATS_FILE))
+    except OSError:
+        pass
+
+
+def file_digest(path):
+    """Returns the digest of the contents of path, or None if it is missing."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(1 << 20), b''):
+                digest.update(chunk)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def input_file_digests(execargs):
+    """Returns the digests of the files named by INPUT_FILE_ARGS."""
+    digests = []
+    for arg in execargs[1:]:
+        if arg.startswith(INPUT_FILE_ARGS):
+            path = arg.split('=', 1)[1]
+            if os.path.isdir(path):
+                # Like clang, look for the default profile in a directory.
+                path = os.path.join(path, 'default.profdata')
+            digests.append(file_digest(path))
+    return digests
+
+
+def cache_key(execargs, *extra):
+    key = json.dumps([os.getcwd(), execargs[1:],
+                      input_file_digests(execargs)] + list(extra))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class CompileCache(object):
+    """Caches the outputs and diagnostics of successful compiles.
+
+    Entries are keyed by the compiler identity, the working directory, the
+    arguments, the contents of the profiles and sanitizer lists they name and
+    the digest of the preprocessed input. Each entry is a
+    directory holding a copy of every output, the diagnostics and a small
+    metadata file. Restoring an entry touches it, and the least recently
+    used entries are evicted when the cache grows past max_size.
+    """
+
+    def __init__(self, cache_dir, execargs, max_size):
+        self.cache_dir = cache_dir
+        self.execargs = execargs
+        self.max_size = max_size
+        self.outputs = output_paths(execargs)
+        self.entry_path = None
+        digest = preprocessed_digest(execargs)
+        if digest is not None:
+            key = cache_key(execargs, digest)
+            self.entry_path = os.path.join(
+                cache_dir, compiler_identity(execargs[0]), key[:2], key)
+
+    def restore(self):
+        """Restores the outputs of the compile from the cache.
+
+        Returns:
+            Whether the cache had the outputs.
+        """
+        if not self.entry_path:
+            return False
+        start_time = time.time()
+        try:
+            with open(os.path.join(self.entry_path, 'meta')) as meta_file:
+                meta = json.load(meta_file)
+            for kind, path in self.outputs.items():
+                shutil.copyfile(os.path.join(self.entry_path, kind), path)
+            with open(os.path.join(self.entry_path, 'stderr'), 'rb') as f:
+                stderr = getattr(sys.stderr, 'buffer', sys.stderr)
+                stderr.write(f.read())
+                stderr.flush()
+            os.utime(self.entry_path, None)
+        except (IOError, OSError, ValueError):
+            return False
+        record_event(self.cache_dir, 'hit',
+                     meta['duration'] - (time.time() - start_time))
+        return True
+
+    def store(self, stderr, duration):
+        """Stores the outputs of the compile that just succeeded.
+
+        stderr is a file object positioned at the start of the diagnostics.
+        """
+        if not self.entry_path:
+            return
+        tmp_path = None
+        try:
+            entry_dir = os.path.dirname(self.entry_path)
+            makedirs(entry_dir)
+            tmp_path = tempfile.mkdtemp(dir=entry_dir)
+            for kind, path in self.outputs.items():
+                shutil.copyfile(path, os.path.join(tmp_path, kind))
+            with open(os.path.join(tmp_path, 'stderr'), 'wb') as f:
+                shutil.copyfileobj(stderr, f)
+            with open(os.path.join(tmp_path, 'meta'), 'w') as f:
+                json.dump({'duration': duration}, f)
+            # Another compile may have stored the same entry meanwhile.
+            os.rename(tmp_path, self.entry_path)
+            tmp_path = None
+            record_event(self.cache_dir, 'miss', duration)
+        except (IOError, OSError):
+            # The cache is only an optimization.
+            pass
+        finally:
+            if tmp_path:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        if random.random() < CLEANUP_PROBABILITY:
+            cleanup(self.cache_dir, self.max_size)
+
+
+def _entry_size(entry_path):
+    if not os.path.isdir(entry_path):
+        return os.path.getsize(entry_path)
+    return sum(
+        os.path.getsize(os.path.join(entry_path, name))
+        for name in os.listdir(entry_path))
+
+
+def _entry_paths(cache_dir):
+    """Returns the paths of the evictable entries of a cache directory.
+
+    These are the compile cache entries (directories) and failure memos
+    (files) under each compiler identity, and the files in the directories of
+    the other users of the cache dir, like compiler_wrapper's parsed response
+    files.
+    """
+    paths = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        # Skip the files of the users of the cache dir, like STATS_FILE.
+        if not os.path.isdir(path):
+            continue
+        if name.startswith('_'):
+            paths.extend(os.path.join(path, entry)
+                         for entry in os.listdir(path))
+            continue
+        for prefix in os.listdir(path):
+            prefix_path = os.path.join(path, prefix)
+            paths.extend(os.path.join(prefix_path, key)
+                         for key in os.listdir(prefix_path))
+    return paths
+
+
+def _remove_entry(cache_dir, entry_path):
+    """Removes an entry and the directories it leaves empty."""
+    if os.path.isdir(entry_path):
+        shutil.rmtree(entry_path, ignore_errors=True)
+    else:
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+    parent = os.path.dirname(entry_path)
+    while parent != cache_dir:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def cleanup(cache_dir, max_size):
+    """Evicts the least recently used entries if the cache is over max_size.
+
+    Every entry counts against max_size, see _entry_paths. Only one process
+    cleans up at a time, the others skip it.
+    """
+    lock_fd = os.open(
+        os.path.join(cache_dir, CLEANUP_LOCK), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+        entries = []
+        total = 0
+        for entry_path in _entry_paths(cache_dir):
+            try:
+                size = _entry_size(entry_path)
+                mtime = os.path.getmtime(entry_path)
+            except OSError:
+                continue
+            entries.append((mtime, size, entry_path))
+            total += size
+        if total <= max_size:
+            return
+        entries.sort()
+        for _, size, entry_path in entries:
+            if total <= max_size * CLEANUP_TARGET:
+                break
+            _remove_entry(cache_dir, entry_path)
+            total -= size
+    finally:
+        os.close(lock_fd)
+
+
+class FailureMemo(object):
+    """Remembers the compiles that fail with the real compiler.
+
+    Entries are looked up by the compiler identity, the working directory, the
+    arguments and the files they name, and only trusted if the preprocessed
+    input is unchanged since the failure was recorded. Like the compile
+    cache, the least recently used entries are evicted when the memo grows
+    past max_size.
+    """
+
+    def __init__(self, cache_dir, execargs, max_size):
+        self.cache_dir = cache_dir
+        self.execargs = execargs
+        self.max_size = max_size
+        key = cache_key(execargs)
+        self.entry_path = os.path.join(cache_dir,
+                                       compiler_identity(execargs[0]), key[:2],
+                                       key)
+
+    def lookup(self):
+        """Returns the recorded failure of this compile, or None.
+
+        The failure is a dict with the exit_code, stderr and duration of the
+        failed compile.
+        """
+        try:
+            with open(self.entry_path) as entry_file:
+                entry = json.load(entry_file)
+        except (IOError, ValueError):
+            return None
+        start_time = time.time()
+        digest = preprocessed_digest(self.execargs)
+        if digest is None or digest != entry['digest']:
+            # The input changed since it failed, compile it again.
+            try:
+                os.remove(self.entry_path)
+            except OSError:
+                pass
+            record_event(self.cache_dir, 'stale', time.time() - start_time)
+            return None
+        # Keep the entry from being evicted as least recently used.
+        try:
+            os.utime(self.entry_path, None)
+        except OSError:
+            pass
+        # The failing compile is skipped, but we paid for preprocessing.
+        record_event(self.cache_dir, 'hit',
+                     entry['duration'] - (time.time() - start_time))
+        return entry
+
+    def record(self, exit_code, stderr, duration):
+        """Records a failure of this compile.
+
+        stderr is a file object positioned at the start of the diagnostics.
+        """
+        try:
+            digest = preprocessed_digest(self.execargs)
+            if digest is None:
+                return
+            log = stderr.read(STDERR_MEMO_LIMIT)
+            if isinstance(log, bytes):
+                log = log.decode('utf-8', 'replace')
+            entry = {
+                'digest': digest,
+                'exit_code': exit_code,
+                'stderr': log,
+                'duration': duration,
+            }
+            write_atomically(self.entry_path,
+                             json.dumps(entry).encode('utf-8'))
+            record_event(self.cache_dir, 'miss', duration)
+        except (IOError, OSError):
+            # The memo is only an optimization.
+            pass
+        if random.random() < CLEANUP_PROBABILITY:
+            cleanup(self.cache_dir, self.max_size)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for compile_cache.py."""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import compile_cache
+
+# Stands in for clang.real, it only needs to preprocess.
+FAKE_COMPILER = """#!/bin/sh
+for arg; do
+    case $arg in *.c) src=$arg;; esac
+done
+cat "$src"
+"""
+
+
+class CompileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.mkdir(self.cache_dir)
+        self.compiler = self.path('clang.real')
+        self.write(self.compiler, FAKE_COMPILER)
+        os.chmod(self.compiler, 0o755)
+        self.write(self.path('foo.c'), 'int foo;\n')
+        self.write(self.path('foo.profdata'), 'profile 1')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    @staticmethod
+    def write(path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def compile_args(self, *flags):
+        return ([self.compiler, '-c', self.path('foo.c'), '-o',
+                 self.path('foo.o')] + list(flags))
+
+    def store(self, execargs):
+        self.write(self.path('foo.o'), 'object')
+        compile_cache.CompileCache(self.cache_dir, execargs,
+                                   1 << 30).store(io.BytesIO(), 1.0)
+
+    def restore(self, execargs):
+        return compile_cache.CompileCache(self.cache_dir, execargs,
+                                          1 << 30).restore()
+
+    def test_hit(self):
+        execargs = self.compile_args()
+        self.store(execargs)
+        self.assertTrue(self.restore(execargs))
+
+    def test_changed_profile_misses(self):
+        for flag in ('-fprofile-use=', '-fprofile-instr-use=',
+                     '-fprofile-sample-use=', '-fsanitize-ignorelist='):
+            self.write(self.path('foo.profdata'), 'profile 1')
+            execargs = self.compile_args(flag + self.path('foo.profdata'))
+            self.store(execargs)
+            self.assertTrue(self.restore(execargs))
+            self.write(self.path('foo.profdata'), 'profile 2')
+            self.assertFalse(self.restore(execargs), flag)
+
+    def test_profile_directory(self):
+        os.mkdir(self.path('profiles'))
+        self.write(self.path('profiles/default.profdata'), 'profile 1')
+        execargs = self.compile_args('-fprofile-use=' + self.path('profiles'))
+        self.store(execargs)
+        self.write(self.path('profiles/default.profdata'), 'profile 2')
+        self.assertFalse(self.restore(execargs))
+
+    def test_cleanup_evicts_memos(self):
+        memo_dir = os.path.join(self.cache_dir, '_RSP_CACHE')
+        os.mkdir(memo_dir)
+        for i in range(4):
+            self.write(os.path.join(memo_dir, str(i)), 'x' * 1000)
+            os.utime(os.path.join(memo_dir, str(i)), (i, i))
+        memo = compile_cache.FailureMemo(self.cache_dir, self.compile_args(),
+                                         1 << 30)
+        memo.record(1, io.BytesIO(b'x' * 1000), 1.0)
+        compile_cache.cleanup(self.cache_dir, 2500)
+        self.assertEqual(sorted(os.listdir(memo_dir)), ['3'])
+        self.assertTrue(os.path.exists(memo.entry_path))
+
+    def test_cleanup_removes_replaced_compiler(self):
+        self.store(self.compile_args())
+        old_entry = compile_cache.CompileCache(
+            self.cache_dir, self.compile_args(), 1 << 30).entry_path
+        os.utime(old_entry, (0, 0))
+        # Replacing clang.real changes its identity.
+        os.utime(self.compiler, (0, 0))
+        self.store(self.compile_args())
+        compile_cache.cleanup(self.cache_dir, 30)
+        identity_dir = os.path.dirname(os.path.dirname(old_entry))
+        self.assertFalse(os.path.exists(identity_dir))
+        self.assertTrue(self.restore(self.compile_args()))
+
+    def test_coverage_is_not_cacheable(self):
+        self.assertTrue(compile_cache.is_cacheable(self.compile_args()))
+        for flag in ('--coverage', '-ftest-coverage'):
+            self.assertFalse(
+                compile_cache.is_cacheable(self.compile_args(flag)))
+
+
+if __name__ == '__main__':
+    unittest.main()
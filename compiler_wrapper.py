@@ -15,14 +15,17 @@
 # limitations under the License.
 #
 
-import errno
-import fcntl
+# Every compile of an Android build starts this script, so the common path
+# (no bisection, no fallback) only imports os, sys and the builtin time module
+# before it execs the real compiler. Modules needed by the other paths are
+# imported where they are used.
 import os
-import shlex
-import subprocess
 import sys
 import time
 
+# Wrapper overhead in telemetry records is measured from here.
+START_TIME = time.time()
+
 BISECT_STAGE = os.environ.get('BISECT_STAGE')
 # We do not need bisect functionality with Goma and clang.
 # Goma server does not have bisect_driver, so we only import
@@ -33,12 +36,34 @@ if BISECT_STAGE:
 
 DEFAULT_BISECT_DIR = os.path.expanduser('~/ANDROID_BISECT')
 BISECT_DIR = os.environ.get('BISECT_DIR') or DEFAULT_BISECT_DIR
+# Parsed response files, shared by all the compiles of a build. They are
+# kept in the bisect dir when bisecting, and in the cache dir of the compile
+# cache or fallback memo otherwise.
+RSP_CACHE_NAME = '_RSP_CACHE'
 STDERR_REDIRECT_KEY = 'ANDROID_LLVM_STDERR_REDIRECT'
+STDERR_SHARDED_KEY = 'ANDROID_LLVM_STDERR_REDIRECT_SHARDED'
 PREBUILT_COMPILER_PATH_KEY = 'ANDROID_LLVM_PREBUILT_COMPILER_PATH'
 DISABLED_WARNINGS_KEY = 'ANDROID_LLVM_FALLBACK_DISABLED_WARNINGS'
+# Directory remembering the compiles that need the fallback, see
+# compile_cache.FailureMemo.
+FALLBACK_CACHE_KEY = 'ANDROID_LLVM_FALLBACK_CACHE_DIR'
+# Local compile cache, see compile_cache.CompileCache.
+CCACHE_DIR_KEY = 'ANDROID_LLVM_CCACHE_DIR'
+CCACHE_MAX_SIZE_KEY = 'ANDROID_LLVM_CCACHE_MAX_SIZE'
+# Log of per-invocation resource usage, see telemetry_report.py.
+TELEMETRY_PATH_KEY = 'ANDROID_LLVM_TELEMETRY_PATH'
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cp', '.cpp', '.cxx', '.c++', '.C', '.m',
+                     '.mm', '.s', '.S')
+# Compiler diagnostics are kept in memory up to this size, and spilled to a
+# temporary file beyond it.
+STDERR_SPILL_SIZE = 1 << 20
+STDERR_CHUNK_SIZE = 64 * 1024
+# At most this much of a failed compile's diagnostics goes to the error log.
+STDERR_LOG_LIMIT = 4 << 20
 
 
 def ProcessArgFile(arg_file):
+    import shlex
     args = []
     # Read in entire file at once and parse as if in shell
     with open(arg_file, 'rb') as f:
@@ -46,25 +71,139 @@ def ProcessArgFile(arg_file):
     return args
 
 
-def write_log(path, command, log):
-    with open(path, 'a+') as f:
-        while True:
-            try:
-                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                break
-            except IOError as e:
-                if e.errno == errno.EAGAIN or e.errno == errno.EACCES:
-                    time.sleep(0.5)
-        f.write('==================COMMAND:====================\n')
-        f.write(' '.join(command) + '\n\n')
-        f.write(log)
-        f.write('==============================================\n\n')
+def ReadArgFile(arg_file, memo_dir):
+    """Parse a response file, reusing a memo of it if it hasn't changed.
+
+    Memos are keyed by the file's path and only used if its mtime and size
+    match the ones recorded in the memo, so a response file shared by many
+    translation units is only parsed once per build and a regenerated one
+    replaces its memo instead of adding another.
+    """
+    import hashlib
+    import marshal
+    import tempfile
+    st = os.stat(arg_file)
+    stamp = (st.st_mtime, st.st_size)
+    key = '%s:%r' % (os.path.abspath(arg_file), sys.version_info[:2])
+    memo_path = os.path.join(memo_dir,
+                             hashlib.sha1(key.encode('utf-8')).hexdigest())
+    try:
+        with open(memo_path, 'rb') as f:
+            memo_stamp, args = marshal.load(f)
+        if memo_stamp == stamp:
+            # compile_cache.cleanup evicts the least recently used memos.
+            os.utime(memo_path, None)
+            return args
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+
+    args = ProcessArgFile(arg_file)
+    try:
+        if not os.path.isdir(memo_dir):
+            os.makedirs(memo_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=memo_dir)
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump((stamp, args), f)
+        os.rename(tmp_path, memo_path)
+    except (IOError, OSError):
+        # The memo is only an optimization.
+        pass
+    return args
+
+
+def ExpandArgFiles(args, memo_dir):
+    """Recursively expand @file arguments in one pass over the output."""
+    expanded = []
+    # Stack of arguments still to process, next one last.
+    pending = list(reversed(args))
+    while pending:
+        arg = pending.pop()
+        if arg.startswith('@'):
+            pending.extend(reversed(ReadArgFile(arg[1:], memo_dir)))
+        else:
+            expanded.append(arg)
+    return expanded
+
+
+def cache_max_size():
+    """Return the size cap of the compile cache and of the fallback memo."""
+    import compile_cache
+    return compile_cache.parse_size(
+        os.environ.get(CCACHE_MAX_SIZE_KEY, compile_cache.DEFAULT_MAX_SIZE))
+
+
+def append_line(path, line):
+    """Append line to the file at path with a single O_APPEND write."""
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def source_file(args):
+    """Return the first source file in args, or None."""
+    for arg in args:
+        if not arg.startswith('-') and arg.endswith(SOURCE_EXTENSIONS):
+            return arg
+    return None
+
+
+def output_file(args):
+    """Return the value of the last -o in args, or None."""
+    output = None
+    for i, arg in enumerate(args[:-1]):
+        if arg == '-o':
+            output = args[i + 1]
+    return output
+
+
+def max_rss_kb(rusage):
+    # ru_maxrss is in bytes on Darwin and in kilobytes elsewhere.
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss // 1024
+    return rusage.ru_maxrss
+
+
+def write_log(path, command, log, exit_code=None, duration=None):
+    """Append a JSON record for a failed command to the log at path.
+
+    log is either a string or a file object positioned at the start of the
+    diagnostics. Each record is a single line written with one O_APPEND
+    write, so concurrent compiles neither interleave nor wait for a lock.
+    If STDERR_SHARDED_KEY is set each process writes to its own shard,
+    path.<pid>, instead. clang_error_log.py merges and queries the logs.
+    """
+    import json
+    if hasattr(log, 'read'):
+        log = log.read(STDERR_LOG_LIMIT + 1)
+    truncated = len(log) > STDERR_LOG_LIMIT
+    log = log[:STDERR_LOG_LIMIT]
+    if isinstance(log, bytes):
+        log = log.decode('utf-8', 'replace')
+
+    record = {
+        'time': time.time(),
+        'cwd': os.getcwd(),
+        'command': command,
+        'exit_code': exit_code,
+        'duration': duration,
+        'stderr': log,
+        'stderr_truncated': truncated,
+    }
+    if os.environ.get(STDERR_SHARDED_KEY):
+        path = '%s.%d' % (path, os.getpid())
+    append_line(path, json.dumps(record, sort_keys=True) + '\n')
 
 
 class CompilerWrapper():
 
-    def __init__(self, argv):
+    def __init__(self, argv, wrapper_path=None):
         self.argv0_current = argv[0]
+        # The path this wrapper was invoked as. It differs from __file__ when
+        # a fast launcher imports this module, see build.install_wrappers.
+        self.wrapper_path = wrapper_path or __file__
+        self.wrapper_name = os.path.basename(self.wrapper_path)
         self.args = argv[1:]
         self.execargs = []
         self.real_compiler = None
@@ -72,14 +211,21 @@ class CompilerWrapper():
         self.append_flags = []
         self.prepend_flags = []
         self.custom_flags = {'--gomacc-path': None}
+        # Resource usage of the compiler runs, and how the compile was done,
+        # for TELEMETRY_PATH_KEY.
+        self.telemetry_path = os.environ.get(TELEMETRY_PATH_KEY)
+        self.usage = {'wall': 0.0, 'user': 0.0, 'sys': 0.0, 'max_rss': 0}
+        self.exit_code = None
+        self.fallback = False
+        self.cache_result = None
 
     def set_real_compiler(self):
         """Find the real compiler with the absolute path."""
         compiler_path = os.path.dirname(self.argv0_current)
-        if os.path.islink(__file__):
-            compiler = os.path.basename(os.readlink(__file__))
+        if os.path.islink(self.wrapper_path):
+            compiler = os.path.basename(os.readlink(self.wrapper_path))
         else:
-            compiler = os.path.basename(os.path.abspath(__file__))
+            compiler = os.path.basename(os.path.abspath(self.wrapper_path))
         self.real_compiler = os.path.join(compiler_path, compiler + '.real')
         self.argv0 = self.real_compiler
 
@@ -116,24 +262,185 @@ class CompilerWrapper():
         self.add_flags()
         self.execargs += [self.real_compiler] + self.args
 
+    def cacheable_args(self, cache_dir):
+        """Return the compiler command for the cache in cache_dir, or None.
+
+        The command starts with the real compiler, even with Goma, and has
+        its response files expanded.
+        """
+        if self.wrapper_name not in ['clang', 'clang++']:
+            return None
+        args = self.execargs[self.execargs.index(self.real_compiler):]
+        args = ExpandArgFiles(args, os.path.join(cache_dir, RSP_CACHE_NAME))
+        import compile_cache
+        return args if compile_cache.is_cacheable(args) else None
+
+    def open_compile_cache(self):
+        cache_dir = os.environ.get(CCACHE_DIR_KEY)
+        args = self.cacheable_args(cache_dir) if cache_dir else None
+        if not args:
+            return None
+        import compile_cache
+        return compile_cache.CompileCache(cache_dir, args, cache_max_size())
+
+    def wait_compiler(self, p, start_time):
+        """Wait for the compiler process p and account for its usage."""
+        _, status, rusage = os.wait4(p.pid, 0)
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        self.usage['wall'] += time.time() - start_time
+        self.usage['user'] += rusage.ru_utime
+        self.usage['sys'] += rusage.ru_stime
+        self.usage['max_rss'] = max(self.usage['max_rss'], max_rss_kb(rusage))
+        self.exit_code = p.returncode
+        return p.returncode
+
+    def run_compiler(self):
+        """Run the compiler, passing its diagnostics through as they arrive.
+
+        Returns:
+            The exit code, a copy of the diagnostics positioned at their start
+            and the duration of the compile. The copy is kept in memory, or
+            spilled to disk past STDERR_SPILL_SIZE.
+        """
+        import subprocess
+        import tempfile
+        start_time = time.time()
+        p = subprocess.Popen(self.execargs, stderr=subprocess.PIPE)
+        err = tempfile.SpooledTemporaryFile(max_size=STDERR_SPILL_SIZE)
+        stderr = getattr(sys.stderr, 'buffer', sys.stderr)
+        while True:
+            chunk = os.read(p.stderr.fileno(), STDERR_CHUNK_SIZE)
+            if not chunk:
+                break
+            stderr.write(chunk)
+            stderr.flush()
+            err.write(chunk)
+        p.stderr.close()
+        self.wait_compiler(p, start_time)
+        err.seek(0)
+        return p.returncode, err, time.time() - start_time
+
+    def exec_compiler(self, argv0, execargs):
+        """Replace this process with the compiler.
+
+        With telemetry the compiler runs as a child instead, so that its
+        resource usage can be recorded, and this process exits with its
+        exit code.
+        """
+        if not self.telemetry_path:
+            os.execv(argv0, execargs)
+        import subprocess
+        start_time = time.time()
+        p = subprocess.Popen(execargs, executable=argv0)
+        sys.exit(self.wait_compiler(p, start_time))
+
+    def exit_like_compiler(self):
+        """Die of the signal that killed the compiler, as if exec'd.
+
+        exec_compiler and compile_with_cache run the compiler as a child, and
+        exiting with its negative return code would report an exit status of
+        256 minus the signal instead.
+        """
+        import signal
+        sig = -self.exit_code
+        signal.signal(sig, signal.SIG_DFL)
+        os.kill(os.getpid(), sig)
+        # Only reached if the signal does not terminate the process.
+        os._exit(128 + sig)
+
+    def write_telemetry(self, bisect_stage=None):
+        """Append a JSON record of this invocation to the telemetry log."""
+        if not self.telemetry_path:
+            return
+        import json
+        user, system = os.times()[:2]
+        wall = time.time() - START_TIME
+        args = self.execargs or self.args
+        record = {
+            'time': START_TIME,
+            'wrapper': self.wrapper_name,
+            'cwd': os.getcwd(),
+            'source': source_file(args),
+            'output': output_file(args),
+            'exit_code': self.exit_code,
+            'wall': self.usage['wall'],
+            'user': self.usage['user'],
+            'sys': self.usage['sys'],
+            'max_rss_kb': self.usage['max_rss'],
+            'fallback': self.fallback,
+            'cache': self.cache_result,
+            'bisect': bisect_stage,
+            'overhead': wall - self.usage['wall'],
+            'wrapper_cpu': user + system,
+        }
+        try:
+            append_line(self.telemetry_path,
+                        json.dumps(record, sort_keys=True) + '\n')
+        except (IOError, OSError):
+            # Telemetry must never break the build.
+            pass
+
+    def compile_with_cache(self, cache):
+        if cache.restore():
+            self.cache_result = 'hit'
+            self.exit_code = 0
+            return 0
+        returncode, err, duration = self.run_compiler()
+        if returncode == 0:
+            self.cache_result = 'miss'
+            cache.store(err, duration)
+        return returncode
+
     def exec_clang_with_fallback(self):
         # We only want to pass extra flags to clang and clang++.
-        if os.path.basename(__file__) in ['clang', 'clang++']:
+        if self.wrapper_name in ['clang', 'clang++']:
             # We may introduce some new warnings after rebasing and we need to
             # disable them before we fix those warnings.
             disabled_warnings_env = os.environ.get(DISABLED_WARNINGS_KEY, '')
             disabled_warnings = disabled_warnings_env.split(' ')
             self.execargs += ['-fno-color-diagnostics'] + disabled_warnings
 
-        p = subprocess.Popen(self.execargs, stderr=subprocess.PIPE)
-        (_, err) = p.communicate()
-        sys.stderr.write(err)
-        if p.returncode != 0:
+        cache = self.open_compile_cache()
+        if cache and cache.restore():
+            self.cache_result = 'hit'
+            self.exit_code = 0
+            sys.exit(0)
+
+        memo = None
+        memo_dir = os.environ.get(FALLBACK_CACHE_KEY)
+        args = self.cacheable_args(memo_dir) if memo_dir else None
+        if args:
+            import compile_cache
+            memo = compile_cache.FailureMemo(memo_dir, args, cache_max_size())
+            failure = memo.lookup()
+            if failure:
+                # Known to fail, go straight to the prebuilt compiler.
+                write_log(os.environ[STDERR_REDIRECT_KEY], self.execargs,
+                          failure['stderr'], failure['exit_code'])
+                self.exec_fallback()
+
+        returncode, err, duration = self.run_compiler()
+        if returncode == 0:
+            if cache:
+                self.cache_result = 'miss'
+                cache.store(err, duration)
+        else:
             redirect_path = os.environ[STDERR_REDIRECT_KEY]
-            write_log(redirect_path, self.execargs, err)
-            fallback_arg0 = os.path.join(os.environ[PREBUILT_COMPILER_PATH_KEY],
-                                         os.path.basename(__file__))
-            os.execv(fallback_arg0, [fallback_arg0] + self.execargs[1:])
+            write_log(redirect_path, self.execargs, err, returncode, duration)
+            if memo:
+                err.seek(0)
+                memo.record(returncode, err, duration)
+            self.exec_fallback()
+
+    def exec_fallback(self):
+        fallback_arg0 = os.path.join(os.environ[PREBUILT_COMPILER_PATH_KEY],
+                                     self.wrapper_name)
+        self.fallback = True
+        self.exec_compiler(fallback_arg0,
+                           [fallback_arg0] + self.execargs[1:])
 
     def invoke_compiler(self):
         enable_fallback = PREBUILT_COMPILER_PATH_KEY in os.environ
@@ -141,33 +448,53 @@ class CompilerWrapper():
         if enable_fallback:
             self.exec_clang_with_fallback()
         else:
-            os.execv(self.argv0, self.execargs)
+            cache = self.open_compile_cache()
+            if cache:
+                sys.exit(self.compile_with_cache(cache))
+            self.exec_compiler(self.argv0, self.execargs)
 
     def bisect(self):
         self.prepare_compiler_args()
         # Handle @file argument syntax with compiler
-        idx = 0
-        # The length of self.execargs can be changed during the @file argument
-        # expansion, so we need to use while loop instead of for loop.
-        while idx < len(self.execargs):
-            if self.execargs[idx][0] == '@':
-                args_in_file = ProcessArgFile(self.execargs[idx][1:])
-                self.execargs = self.execargs[0:idx] + args_in_file +\
-                        self.execargs[idx + 1:]
-                # Skip update of idx, since we want to recursively expand
-                # response files.
-            else:
-                idx = idx + 1
-        bisect_driver.bisect_driver(BISECT_STAGE, BISECT_DIR, self.execargs)
+        self.execargs = ExpandArgFiles(self.execargs,
+                                       os.path.join(BISECT_DIR, RSP_CACHE_NAME))
+        if not self.telemetry_path:
+            self.exit_code = bisect_driver.bisect_driver(
+                BISECT_STAGE, BISECT_DIR, self.execargs)
+            return
+        # bisect_driver waits for the compiler itself, so account for all
+        # the children instead.
+        import resource
+        start_time = time.time()
+        self.exit_code = bisect_driver.bisect_driver(BISECT_STAGE, BISECT_DIR,
+                                                     self.execargs)
+        rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.usage = {
+            'wall': time.time() - start_time,
+            'user': rusage.ru_utime,
+            'sys': rusage.ru_stime,
+            'max_rss': max_rss_kb(rusage),
+        }
 
 
-def main(argv):
-    cw = CompilerWrapper(argv)
+def main(argv, wrapper_path=None):
+    cw = CompilerWrapper(argv, wrapper_path)
     if BISECT_STAGE and BISECT_STAGE in bisect_driver.VALID_MODES\
             and '-o' in argv:
-        cw.bisect()
+        try:
+            cw.bisect()
+        finally:
+            cw.write_telemetry(BISECT_STAGE)
+        if cw.exit_code < 0:
+            cw.exit_like_compiler()
+        sys.exit(cw.exit_code)
     else:
-        cw.invoke_compiler()
+        try:
+            cw.invoke_compiler()
+        finally:
+            cw.write_telemetry()
+            if cw.exit_code is not None and cw.exit_code < 0:
+                cw.exit_like_compiler()
 
 
 if __name__ == '__main__':
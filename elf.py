@@ -0,0 +1,248 @@
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Reads the sections and symbols of ELF files without external tools.
+
+Both ELF32 and ELF64 files of either endianness are supported, so target
+libraries can be read on any host.
+"""
+
+import collections
+import mmap
+import struct
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+
+SHF_WRITE = 0x1
+SHF_EXECINSTR = 0x4
+
+SHN_UNDEF = 0
+SHN_ABS = 0xfff1
+SHN_COMMON = 0xfff2
+
+STB_LOCAL = 0
+STB_GLOBAL = 1
+STB_WEAK = 2
+STB_GNU_UNIQUE = 10
+
+STT_OBJECT = 1
+STT_GNU_IFUNC = 10
+
+# Layouts of the header fields after e_ident, and of the section headers.
+_HEADER_FORMATS = {
+    ELFCLASS32: 'HHIIIIIHHHHHH',
+    ELFCLASS64: 'HHIQQQIHHHHHH',
+}
+_SECTION_FORMATS = {
+    ELFCLASS32: 'IIIIIIIIII',
+    ELFCLASS64: 'IIQQQQIIQQ',
+}
+_SYMBOL_FORMATS = {
+    ELFCLASS32: 'IIIBBH',
+    ELFCLASS64: 'IBBHQQ',
+}
+
+Section = collections.namedtuple(
+    'Section', ['name', 'type', 'flags', 'offset', 'size', 'link', 'entsize'])
+
+Symbol = collections.namedtuple(
+    'Symbol', ['name', 'value', 'size', 'binding', 'type', 'shndx'])
+
+
+class ElfError(Exception):
+    """Raised for files that start like ELF files but are malformed."""
+
+
+class ElfFile(object):
+    """An ELF file mapped into memory.
+
+    Use as a context manager, or call close() when done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as elf_file:
+            try:
+                self.data = mmap.mmap(
+                    elf_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ElfError('%s is empty' % path)
+        try:
+            self._read_header()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def _unpack(self, fmt, offset):
+        if offset + struct.calcsize(fmt) > len(self.data):
+            raise ElfError('%s is truncated' % self.path)
+        return struct.unpack_from(fmt, self.data, offset)
+
+    def _read_header(self):
+        if self.data[:4] != ELF_MAGIC:
+            raise ElfError('%s is not an ELF file' % self.path)
+        self.elf_class, data = self._unpack('BB', 4)
+        if self.elf_class not in _HEADER_FORMATS or data not in (
+                ELFDATA2LSB, ELFDATA2MSB):
+            raise ElfError('%s has an unknown ELF class or data encoding' %
+                           self.path)
+        self.endian = '<' if data == ELFDATA2LSB else '>'
+        header = self._unpack(self.endian + _HEADER_FORMATS[self.elf_class],
+                              16)
+        shoff, shentsize, shnum = header[5], header[10], header[11]
+        self.sections = []
+        if not shoff:
+            return
+
+        section_fmt = self.endian + _SECTION_FORMATS[self.elf_class]
+
+        def read_section(index):
+            fields = self._unpack(section_fmt, shoff + index * shentsize)
+            return Section(fields[0], fields[1], fields[2], fields[4],
+                           fields[5], fields[6], fields[9])
+
+        if shnum == 0:
+            # More sections than fit in e_shnum, the count is in the size of
+            # the first section header.
+            shnum = read_section(0).size
+        self.sections = [read_section(index) for index in range(shnum)]
+
+    def string(self, table, offset):
+        """Returns the NUL-terminated string at offset in section table."""
+        start = table.offset + offset
+        end = self.data.find(b'\0', start, table.offset + table.size)
+        if end < 0:
+            raise ElfError('%s has an unterminated string' % self.path)
+        return self.data[start:end]
+
+    def symbols(self):
+        """Returns the symbols of .symtab, or of .dynsym if it is stripped.
+
+        Symbol names are bytes.
+        """
+        tables = [section for section in self.sections
+                  if section.type == SHT_SYMTAB]
+        if not tables:
+            tables = [section for section in self.sections
+                      if section.type == SHT_DYNSYM]
+        if not tables:
+            return []
+        table = tables[0]
+        strings = self.sections[table.link]
+        fmt = self.endian + _SYMBOL_FORMATS[self.elf_class]
+        entsize = table.entsize or struct.calcsize(fmt)
+        symbols = []
+        # The first entry of a symbol table is always the null symbol.
+        for offset in range(table.offset + entsize,
+                            table.offset + table.size, entsize):
+            fields = self._unpack(fmt, offset)
+            if self.elf_class == ELFCLASS32:
+                name, value, size, info, _, shndx = fields
+            else:
+                name, info, _, shndx, value, size = fields
+            symbols.append(
+                Symbol(self.string(strings, name), value, size, info >> 4,
+                       info & 0xf, shndx))
+        return symbols
+
+    def nm_code(self, symbol):
+        """Returns the symbol type letter nm prints for symbol."""
+        if symbol.shndx == SHN_UNDEF:
+            return 'w' if symbol.binding == STB_WEAK else 'U'
+        if symbol.binding == STB_GNU_UNIQUE:
+            return 'u'
+        if symbol.binding == STB_WEAK:
+            return 'V' if symbol.type == STT_OBJECT else 'W'
+        if symbol.type == STT_GNU_IFUNC:
+            return 'i'
+        if symbol.shndx == SHN_ABS:
+            code = 'a'
+        elif symbol.shndx == SHN_COMMON:
+            code = 'c'
+        elif symbol.shndx >= len(self.sections):
+            code = '?'
+        else:
+            section = self.sections[symbol.shndx]
+            if section.type == SHT_NOBITS:
+                code = 'b'
+            elif section.flags & SHF_EXECINSTR:
+                code = 't'
+            elif section.flags & SHF_WRITE:
+                code = 'd'
+            else:
+                code = 'r'
+        return code.upper() if symbol.binding == STB_GLOBAL else code
+
+
+def is_elf(path):
+    with open(path, 'rb') as elf_file:
+        return elf_file.read(4) == ELF_MAGIC
+
+
+def read_sections(path):
+    """Returns the section headers of path, or None if it is not ELF.
+
+    The name of each Section is its offset in the section name table.
+    """
+    if not is_elf(path):
+        return None
+    with ElfFile(path) as elf_file:
+        return elf_file.sections
+
+
+def global_symbols(path):
+    """Returns what nm -g --defined-only prints for path.
+
+    Returns:
+        List of (name, nm type letter) of the defined global and weak
+        symbols, sorted by name.
+    """
+    with ElfFile(path) as elf_file:
+        symbols = [(symbol.name, elf_file.nm_code(symbol))
+                   for symbol in elf_file.symbols()
+                   if symbol.binding != STB_LOCAL and
+                   symbol.shndx != SHN_UNDEF]
+    if not isinstance(b'', str):
+        symbols = [(name.decode('utf-8'), code) for name, code in symbols]
+    return sorted(symbols)
+
+
+def is_stripped(path):
+    """Returns whether path is an ELF file without a symbol table.
+
+    Files that are not ELF are never considered stripped.
+    """
+    sections = read_sections(path)
+    if sections is None:
+        return False
+    return not any(section.type == SHT_SYMTAB for section in sections)
@@ -16,16 +16,17 @@
 #
 
 import sys
-import subprocess
+
+import elf
 
 def create_map_file(lib_file, map_file):
     output = open(map_file, 'w')
-    symbols = subprocess.check_output(['nm', '-g', '--defined-only', lib_file])
     output.write('# AUTO-GENERATED by mapfile.py. DO NOT EDIT.\n')
     output.write('LIBCLANG_RT_ASAN {\n')
     output.write('  global:\n')
-    for line in symbols.splitlines():
-        _, symbol_type, symbol_name = line.split(' ', 2)
+    # Symbols are read in process rather than with the host nm, which may
+    # not understand the target architecture.
+    for symbol_name, symbol_type in elf.global_symbols(lib_file):
         if symbol_type in ['T', 'W', 'B']:
             output.write('    {};\n'.format(symbol_name))
 
@@ -34,6 +35,18 @@ def create_map_file(lib_file, map_file):
     output.write('};\n')
     output.close()
 
+def _create_map_file(args):
+    create_map_file(*args)
+
+def create_map_files(lib_and_map_files, pool):
+    """Runs create_map_file for each (lib_file, map_file) on a process pool.
+
+    The pool is passed in so that callers running threads can create it
+    before starting them: forking a process that has other threads running
+    can leave locks held in the child.
+    """
+    pool.map(_create_map_file, lib_and_map_files)
+
 # for testing and standalone usage.
 if __name__ == '__main__':
     create_map_file(sys.argv[1], sys.argv[2])
@@ -0,0 +1,150 @@
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Runs build steps concurrently, each one after the steps it depends on."""
+
+import contextlib
+import logging
+import threading
+import time
+import traceback
+
+import build_trace
+
+
+def logger():
+    """Returns the module level logger."""
+    return logging.getLogger(__name__)
+
+
+class Task(object):
+    """A named build step and the names of the steps it depends on."""
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+
+
+def run_tasks(tasks, max_workers):
+    """Runs tasks on up to max_workers threads.
+
+    A task starts once all of its dependencies have finished. Tasks that are
+    ready at the same time start in the order they are listed. If a task
+    fails, no further tasks are started, and the first failure is raised once
+    the running tasks have finished.
+
+    Returns:
+        Tuple of the summed duration of the tasks and the wall time, in
+        seconds.
+    """
+    names = set(task.name for task in tasks)
+    for task in tasks:
+        for dep in task.deps:
+            if dep not in names:
+                raise ValueError('%s depends on unknown task %s' %
+                                 (task.name, dep))
+
+    pending = list(tasks)
+    done = set()
+    failures = []
+    durations = []
+    running = [0]
+    cond = threading.Condition()
+
+    def run(task):
+        start = time.time()
+        try:
+            with build_trace.span(task.name, 'task'):
+                task.func()
+        except Exception as e:
+            logger().error('%s failed:\n%s', task.name, traceback.format_exc())
+            with cond:
+                failures.append(e)
+        finally:
+            with cond:
+                durations.append(time.time() - start)
+                done.add(task.name)
+                running[0] -= 1
+                cond.notify_all()
+
+    start = time.time()
+    with cond:
+        while True:
+            if not failures:
+                ready = [task for task in pending
+                         if all(dep in done for dep in task.deps)]
+                for task in ready[:max_workers - running[0]]:
+                    pending.remove(task)
+                    running[0] += 1
+                    logger().info('Starting %s', task.name)
+                    thread = threading.Thread(
+                        target=run, args=(task,), name=task.name)
+                    thread.start()
+            if not running[0]:
+                break
+            cond.wait()
+
+    if failures:
+        raise failures[0]
+    if pending:
+        raise ValueError('Dependency cycle between: %s' %
+                         ', '.join(task.name for task in pending))
+    return sum(durations), time.time() - start
+
+
+class CpuBudget(object):
+    """A pool of CPU slots shared by build steps running at the same time.
+
+    This plays the part of a jobserver for ninja, which cannot share one:
+    each step takes some slots, runs ninja with that many jobs and gives the
+    slots back when it is done.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.available = total
+        self._cond = threading.Condition()
+
+    def acquire(self, wanted=None):
+        """Takes up to wanted slots, all of them if wanted is None.
+
+        Blocks until at least one slot is free.
+
+        Returns:
+            The number of slots taken.
+        """
+        wanted = self.total if wanted is None else max(1, wanted)
+        with self._cond:
+            while not self.available:
+                self._cond.wait()
+            granted = min(wanted, self.available)
+            self.available -= granted
+            return granted
+
+    def release(self, count):
+        with self._cond:
+            self.available += count
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, wanted=None):
+        """Context manager holding slots for its body, yields their number."""
+        granted = self.acquire(wanted)
+        try:
+            yield granted
+        finally:
+            self.release(granted)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Summarize the telemetry log written by compiler_wrapper.py.
+
+The log is enabled by pointing ANDROID_LLVM_TELEMETRY_PATH at a file.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import math
+import sys
+
+OVERHEAD_PERCENTILES = (50, 90, 99)
+
+
+def load_records(path):
+    records = []
+    with open(path) as log_file:
+        for line in log_file:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def percentile(values, pct):
+    """Returns the pct-th percentile of values, by the nearest rank."""
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(1, min(rank, len(values))) - 1]
+
+
+def describe(record):
+    return record['source'] or record['output'] or '(no source)'
+
+
+def print_top(title, records, key, fmt, top):
+    print('\n%s:' % title)
+    for record in sorted(records, key=key, reverse=True)[:top]:
+        print('  %s  %s' % (fmt % key(record), describe(record)))
+
+
+def report(records, top):
+    print('%d invocations' % len(records))
+    wrappers = collections.Counter(record['wrapper'] for record in records)
+    for wrapper, count in wrappers.most_common():
+        print('  %6d  %s' % (count, wrapper))
+
+    cpu = sum(record['user'] + record['sys'] for record in records)
+    wall = sum(record['wall'] for record in records)
+    print('\nCompiler time: %.1fs wall, %.1fs CPU' % (wall, cpu))
+    fallbacks = sum(1 for record in records if record['fallback'])
+    bisects = sum(1 for record in records if record['bisect'])
+    failures = sum(1 for record in records if record['exit_code'])
+    print('Fallback compiles: %d, bisect compiles: %d, failures: %d' %
+          (fallbacks, bisects, failures))
+    cache = collections.Counter(
+        record['cache'] for record in records if record['cache'])
+    if cache:
+        print('Compile cache: %d hits, %d misses' % (cache['hit'],
+                                                     cache['miss']))
+
+    print_top('Slowest translation units', records,
+              lambda record: record['wall'], '%8.2fs', top)
+    print_top('Heaviest translation units (max RSS)', records,
+              lambda record: record['max_rss_kb'] / 1024.0, '%7.0fMB', top)
+
+    overheads = [record['overhead'] for record in records]
+    cpu_overheads = [record['wrapper_cpu'] for record in records]
+    print('\nWrapper overhead:')
+    for pct in OVERHEAD_PERCENTILES:
+        print('  p%-3d %7.1fms wall %7.1fms CPU' %
+              (pct, 1000 * percentile(overheads, pct),
+               1000 * percentile(cpu_overheads, pct)))
+    print('  max  %7.1fms wall %7.1fms CPU' % (1000 * max(overheads),
+                                               1000 * max(cpu_overheads)))
+    print('  total %.1fs wall' % sum(overheads))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('log', help='Path of the telemetry log.')
+    parser.add_argument(
+        '--top', type=int, default=10, help='Number of entries to list.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    records = load_records(args.log)
+    if not records:
+        print('No records in %s' % args.log)
+        return 0
+    report(records, args.top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
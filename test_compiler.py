@@ -17,6 +17,7 @@
 
 import argparse
 import build
+import compile_cache
 import compiler_wrapper
 import multiprocessing
 import os
@@ -106,6 +107,19 @@ def parse_args():
         help='Build for specified '
         'target. This will work only when --build-only is '
         'enabled.')
+    parser.add_argument(
+        '--fast-wrapper',
+        action='store_true',
+        default=False,
+        help='Install fast-startup launchers for the compiler wrapper.')
+    parser.add_argument(
+        '--ccache-dir',
+        help='Cache compile outputs in this directory across builds.')
+    parser.add_argument(
+        '--ccache-max-size',
+        default=compile_cache.DEFAULT_MAX_SIZE,
+        help='Size cap of the compile cache, e.g. 50G '
+        '(defaults to %(default)s).')
     parser.add_argument(
         '--with-tidy',
         action='store_true',
@@ -211,6 +225,7 @@ def build_target(android_base, clang_version, target, max_jobs, redirect_stderr,
         env[compiler_wrapper.PREBUILT_COMPILER_PATH_KEY] = fallback_path
         env[compiler_wrapper.DISABLED_WARNINGS_KEY] = ' '.join(
             DISABLED_WARNINGS)
+        env[compiler_wrapper.FALLBACK_CACHE_KEY] = fallback_cache_dir()
 
     env['LLVM_PREBUILTS_VERSION'] = 'clang-dev'
     env['LLVM_RELEASE_VERSION'] = clang_version.long_version()
@@ -236,6 +251,34 @@ def build_target(android_base, clang_version, target, max_jobs, redirect_stderr,
         env=env)
 
 
+def fallback_cache_dir():
+    return utils.out_path('clang-fallback-cache')
+
+
+def print_fallback_summary():
+    stats = compile_cache.read_stats(fallback_cache_dir())
+    hits, saved = stats.get('hit', (0, 0.0))
+    misses, _ = stats.get('miss', (0, 0.0))
+    stale, _ = stats.get('stale', (0, 0.0))
+    fallbacks = hits + misses
+    if not fallbacks:
+        return
+    print('Fallback compiles: %d, memoized: %d (%.1f%%), stale memos: %d, '
+          'time saved: %.1fs' % (fallbacks, hits, 100.0 * hits / fallbacks,
+                                 stale, saved))
+
+
+def print_ccache_summary(ccache_dir):
+    stats = compile_cache.read_stats(ccache_dir)
+    hits, saved = stats.get('hit', (0, 0.0))
+    misses, _ = stats.get('miss', (0, 0.0))
+    if not hits + misses:
+        return
+    print('Compile cache: %d hits, %d misses (%.1f%% hit rate), '
+          'time saved: %.1fs' % (hits, misses, 100.0 * hits / (hits + misses),
+                                 saved))
+
+
 def test_device(android_base, clang_version, device, max_jobs, clean_output,
                 flashall_path, redirect_stderr, with_tidy):
     [label, target] = device[-1].split(':')
@@ -303,8 +346,17 @@ def main():
     else:
         clang_path = args.clang_path
         clang_version = build.extract_clang_version(clang_path)
-    build.install_wrappers(clang_path)
+    build.install_wrappers(clang_path, fast_launcher=args.fast_wrapper)
     link_clang(args.android_path, clang_path)
+    build.check_create_path(fallback_cache_dir())
+    compile_cache.reset_stats(fallback_cache_dir())
+    if args.ccache_dir:
+        # Inherited by the build environment of every target.
+        ccache_dir = os.path.abspath(args.ccache_dir)
+        build.check_create_path(ccache_dir)
+        compile_cache.reset_stats(ccache_dir)
+        os.environ[compiler_wrapper.CCACHE_DIR_KEY] = ccache_dir
+        os.environ[compiler_wrapper.CCACHE_MAX_SIZE_KEY] = args.ccache_max_size
 
     if args.build_only:
         profiler = ClangProfileHandler() if args.profile else None
@@ -329,6 +381,11 @@ def main():
             if not result and not args.keep_going:
                 break
 
+    if args.redirect_stderr:
+        print_fallback_summary()
+    if args.ccache_dir:
+        print_ccache_summary(ccache_dir)
+
 
 if __name__ == '__main__':
     main()
@@ -18,6 +18,7 @@
 """Update the prebuilt clang from the build server."""
 
 import argparse
+import glob
 import inspect
 import logging
 import os
@@ -26,6 +27,8 @@ import subprocess
 import sys
 import utils
 
+import archive
+
 
 BRANCH = 'aosp-llvm-toolchain'
 
@@ -87,8 +90,20 @@ def fetch_artifact(branch, target, build, pattern):
 
 
 def extract_package(package, install_dir):
-    cmd = ['tar', 'xf', package, '-C', install_dir]
-    check_call(cmd)
+    # Packages may be compressed with any of the formats of build.py
+    # --package-format.
+    archive.extract(package, install_dir)
+
+
+def find_package(download_dir, build_number, host):
+    pattern = os.path.join(download_dir,
+                           'clang-{}-{}.tar.*'.format(build_number, host))
+    packages = [package for package in glob.glob(pattern)
+                if not package.endswith(archive.MANIFEST_EXTENSION)]
+    if len(packages) != 1:
+        raise RuntimeError('Expected one package matching {}, found {}'.format(
+            pattern, len(packages)))
+    return packages[0]
 
 
 def update_clang(host, build_number, use_current_branch, download_dir, bug,
@@ -104,8 +119,7 @@ def update_clang(host, build_number, use_current_branch, download_dir, bug,
             ['repo', 'start', branch_name, '.'])
 
     host_filename = 'windows-i386' if host == 'windows-x86_32' else host
-    package = '{}/clang-{}-{}.tar.bz2'.format(
-            download_dir, build_number, host_filename)
+    package = find_package(download_dir, build_number, host_filename)
     manifest_file = '{}/{}'.format(download_dir, manifest)
 
     install_subdir = 'clang-' + build_number
@@ -154,7 +168,7 @@ def main():
 
     targets = ['linux', 'darwin_mac']
     hosts = ['darwin-x86', 'linux-x86', 'windows-x86', 'windows-x86_32']
-    clang_pattern = 'clang-*.tar.bz2'
+    clang_pattern = 'clang-*.tar.*'
     manifest = 'manifest_{}.xml'.format(args.build)
     branch = 'aosp-llvm-toolchain'
 
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Benchmarks for compiler_wrapper.py.
+
+rsp: expands multi-megabyte response files, split into many nested files,
+the way compiler_wrapper used to (list splicing) and with ExpandArgFiles,
+both without and with its memo.
+
+startup: measures the per-invocation overhead of the wrapper and of the
+fast launcher of build.install_wrappers over running clang.real directly,
+with a clang.real that exits at once.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import build
+import compiler_wrapper
+
+WRAPPER_MODULES = ('compiler_wrapper.py', 'bisect_driver.py',
+                   'compile_cache.py')
+
+
+def splice_expand(args):
+    """Expands @file arguments the way CompilerWrapper.bisect used to."""
+    idx = 0
+    while idx < len(args):
+        if args[idx][0] == '@':
+            args = (args[0:idx] + compiler_wrapper.ProcessArgFile(
+                args[idx][1:]) + args[idx + 1:])
+        else:
+            idx = idx + 1
+    return args
+
+
+def write_rsp_files(rsp_dir, megabytes, files):
+    """Writes a response file including files others, megabytes in total.
+
+    Returns:
+        The path of the top-level response file.
+    """
+    line = '-I/out/soong/.intermediates/some/long/include/path/%d\n'
+    per_file = megabytes * (1 << 20) // files // len(line % 0)
+    top = []
+    for i in range(files):
+        path = os.path.join(rsp_dir, 'part%d.rsp' % i)
+        with open(path, 'w') as rsp:
+            rsp.writelines(line % j for j in range(per_file))
+        top.append('-DPART%d @%s\n' % (i, path))
+    top_path = os.path.join(rsp_dir, 'top.rsp')
+    with open(top_path, 'w') as rsp:
+        rsp.writelines(top)
+    return top_path
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def benchmark_rsp(sizes, files):
+    """Returns a list of (megabytes, arguments, splice, cold, memo) times."""
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for megabytes in sizes:
+            rsp_dir = os.path.join(tmp_dir, str(megabytes))
+            memo_dir = os.path.join(rsp_dir, 'memo')
+            os.mkdir(rsp_dir)
+            args = ['clang', '-c', '@' + write_rsp_files(rsp_dir, megabytes,
+                                                         files)]
+            splice_time, expected = timed(splice_expand, args)
+            cold_time, expanded = timed(compiler_wrapper.ExpandArgFiles, args,
+                                        memo_dir)
+            memo_time, memoized = timed(compiler_wrapper.ExpandArgFiles, args,
+                                        memo_dir)
+            if not expected == expanded == memoized:
+                raise RuntimeError('Expansions differ for %d MB' % megabytes)
+            results.append((megabytes, len(expanded), splice_time, cold_time,
+                            memo_time))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def print_rsp(results):
+    print('%5s %10s %10s %10s %10s' % ('MB', 'args', 'splice', 'one pass',
+                                       'memo'))
+    for megabytes, count, splice_time, cold_time, memo_time in results:
+        print('%5d %10d %9.3fs %9.3fs %9.3fs' % (megabytes, count, splice_time,
+                                                 cold_time, memo_time))
+
+
+def install_startup_bins(tmp_dir):
+    """Installs a clang.real that exits at once, and wrappers in front of it.
+
+    Returns:
+        Dict of the commands to time, by name.
+    """
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    plain_dir = os.path.join(tmp_dir, 'plain')
+    fast_dir = os.path.join(tmp_dir, 'fast')
+    for bin_dir in (plain_dir, fast_dir):
+        os.mkdir(bin_dir)
+        shutil.copy2('/bin/true', os.path.join(bin_dir, 'clang.real'))
+        for module in WRAPPER_MODULES:
+            shutil.copy2(os.path.join(src_dir, module), bin_dir)
+
+    # The plain wrapper runs with the same interpreter as the launcher.
+    with open(os.path.join(src_dir, 'compiler_wrapper.py')) as f:
+        wrapper = f.read().split('\n', 1)[1]
+    plain = os.path.join(plain_dir, 'clang')
+    with open(plain, 'w') as f:
+        f.write('#!%s\n%s' % (sys.executable, wrapper))
+    os.chmod(plain, 0o755)
+
+    py_compile.compile(os.path.join(fast_dir, 'compiler_wrapper.py'),
+                       doraise=True)
+    fast = os.path.join(fast_dir, 'clang')
+    with open(fast, 'w') as f:
+        f.write(build.FAST_LAUNCHER.format(python=sys.executable))
+    os.chmod(fast, 0o755)
+
+    return {
+        'clang.real': os.path.join(plain_dir, 'clang.real'),
+        'wrapper': plain,
+        'fast launcher': fast,
+    }
+
+
+def benchmark_startup(runs):
+    """Returns a list of (name, seconds per invocation)."""
+    env = dict(os.environ)
+    for key in ('BISECT_STAGE', compiler_wrapper.PREBUILT_COMPILER_PATH_KEY,
+                compiler_wrapper.CCACHE_DIR_KEY,
+                compiler_wrapper.TELEMETRY_PATH_KEY):
+        env.pop(key, None)
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        commands = install_startup_bins(tmp_dir)
+        for name in ('clang.real', 'wrapper', 'fast launcher'):
+            cmd = [commands[name], '-c', 'foo.c', '-o', 'foo.o']
+            # Warm up the page cache and the .pyc files.
+            subprocess.check_call(cmd, env=env)
+            start = time.time()
+            for _ in range(runs):
+                subprocess.check_call(cmd, env=env)
+            results.append((name, (time.time() - start) / runs))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def print_startup(results):
+    direct = results[0][1]
+    print('%-14s %12s %12s' % ('', 'invocation', 'overhead'))
+    for name, seconds in results:
+        print('%-14s %10.2fms %10.2fms' % (name, 1000 * seconds,
+                                           1000 * (seconds - direct)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    rsp_parser = subparsers.add_parser(
+        'rsp', help='Compare response file expansions.')
+    rsp_parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=[1, 4, 16],
+        help='Total sizes of the response files, in MB.')
+    rsp_parser.add_argument(
+        '--files',
+        type=int,
+        default=256,
+        help='Number of response files the total is split into.')
+    startup_parser = subparsers.add_parser(
+        'startup', help='Compare wrapper startup with running clang.real.')
+    startup_parser.add_argument(
+        '--runs', type=int, default=200, help='Invocations of each command.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'rsp':
+        print_rsp(benchmark_rsp(args.sizes, args.files))
+    elif args.command == 'startup':
+        print_startup(benchmark_startup(args.runs))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())